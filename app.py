@@ -1,8 +1,14 @@
-import asyncio
 import time
-import mimetypes
+import multiprocessing
 import os
 import html
+import threading
+from collections import OrderedDict
+from string import Template
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from typing import Optional
 
 import streamlit as st
 from dotenv import load_dotenv
@@ -10,18 +16,12 @@ from dotenv import load_dotenv
 load_dotenv()
 
 from src.imap_client import AsyncIMAPClient
+from src.imap_pool import run_in_loop, submit, with_client, close_user_clients
 from src.email_parser import EmailParser
-from src.token_utils import (
-    get_gmail_email,
-    refresh_gmail_access_token,
-    refresh_outlook_access_token,
-    get_outlook_email_from_access_token,
-)
 from src.auth import authenticate_user, register_user
 from src.accounts import (
     list_email_accounts_for_user,
     create_email_account_for_user,
-    get_access_token_for_account,
 )
 
 
@@ -30,48 +30,17 @@ from src.accounts import (
 # -------------------------------------------------------------------
 st.set_page_config(page_title="IMAP Email Viewer POC", layout="wide")
 
-st.markdown(
-    """
-    <style>
-    .subject-line {
-        font-weight: 600;
-        font-size: 1.05rem;
-    }
-    .email-meta {
-        font-size: 0.9rem;
-        color: #888888;
-    }
-    .stTabs [role="tablist"] {
-        border-bottom: 1px solid #33333333;
-    }
-    .stTabs [role="tab"] {
-        padding-top: 0.5rem;
-        padding-bottom: 0.5rem;
-    }
-    .connect-btns {
-        display: flex;
-        gap: 0.5rem;
-    }
-    .connect-btn {
-        display: inline-flex;
-        align-items: center;
-        gap: 0.5rem;
-        padding: 0.55rem 0.9rem;
-        border-radius: 8px;
-        font-weight: 600;
-        text-decoration: none;
-        color: var(--text-color);
-        background: linear-gradient(180deg, #ffffff11 0%, #ffffff06 100%);
-        border: 1px solid rgba(255,255,255,0.06);
-        box-shadow: 0 4px 10px rgba(0,0,0,0.18);
-    }
-    .connect-btn:hover { transform: translateY(-1px); }
-    .connect-gmail { background: linear-gradient(90deg, #e94235 0%, #c92b1f 100%); color: white; }
-    .connect-outlook { background: linear-gradient(90deg, #0078d4 0%, #005ea6 100%); color: white; }
-    </style>
-    """,
-    unsafe_allow_html=True,
-)
+
+@st.cache_resource
+def _css() -> str:
+    # Read once per process; reruns only re-emit the cached string
+    with open(os.path.join(os.path.dirname(__file__), "assets", "app.css"), encoding="utf-8") as f:
+        return f.read()
+
+
+# Must be emitted on every run: Streamlit removes elements a rerun doesn't send,
+# so injecting once per process would unstyle the page after the first click.
+st.html(f"<style>{_css()}</style>")
 
 st.title("📬 IMAP Email Viewer")
 
@@ -83,20 +52,34 @@ st.caption(
 # -------------------------------------------------------------------
 # Session state
 # -------------------------------------------------------------------
-if "connected" not in st.session_state:
-    st.session_state.connected = False
-if "parsed_messages" not in st.session_state:
-    st.session_state.parsed_messages = []
-if "selected_index" not in st.session_state:
-    st.session_state.selected_index = 0
-if "connection_info" not in st.session_state:
-    st.session_state.connection_info = {}
-if "user_id" not in st.session_state:
-    st.session_state.user_id = None
-if "user_email" not in st.session_state:
-    st.session_state.user_email = None
-if "selected_account_id" not in st.session_state:
-    st.session_state.selected_account_id = None
+_SESSION_DEFAULTS = {
+    "connected": False,
+    "parsed_messages": [],
+    "selected_index": 0,
+    "connection_info": {},
+    "user_id": None,
+    "user_email": None,
+    "selected_account_id": None,
+}
+for _key, _value in _SESSION_DEFAULTS.items():
+    st.session_state.setdefault(_key, _value)
+
+
+def _list_accounts(user_id: int):
+    """
+    The user's email accounts, kept in session state so widget reruns don't
+    query SQLite. Call _invalidate_accounts() whenever the list may change.
+    """
+    if st.session_state.get("_accounts_cache_uid") != user_id:
+        st.session_state["_accounts_cache"] = list_email_accounts_for_user(user_id)
+        st.session_state["_accounts_cache_uid"] = user_id
+    return st.session_state["_accounts_cache"]
+
+
+def _invalidate_accounts() -> None:
+    st.session_state.pop("_accounts_cache", None)
+    st.session_state.pop("_accounts_cache_uid", None)
+
 
 connect_btn: bool = False
 fetch_limit: int = 10
@@ -155,17 +138,19 @@ with st.sidebar:
         st.subheader("Logged in")
         st.write(st.session_state.user_email)
         if st.button("Log out"):
+            run_in_loop(close_user_clients(st.session_state.user_id))
             st.session_state.user_id = None
             st.session_state.user_email = None
             st.session_state.connected = False
             st.session_state.parsed_messages = []
+            _invalidate_accounts()
             st.rerun()
 
         # ---------------- Email accounts for this user ----------------
         st.markdown("---")
         st.subheader("Email Accounts")
 
-        accounts = list_email_accounts_for_user(st.session_state.user_id)
+        accounts = _list_accounts(st.session_state.user_id)
         selected_account_id = None
 
         if accounts:
@@ -173,9 +158,12 @@ with st.sidebar:
                 f"{acc.provider.upper()} • {acc.email_address}"
                 for acc in accounts
             ]
-            id_map = {labels[i]: accounts[i].id for i in range(len(accounts))}
-            selected_label = st.selectbox("Select account", options=labels)
-            selected_account_id = id_map[selected_label]
+            selected_pos = st.selectbox(
+                "Select account",
+                options=range(len(accounts)),
+                format_func=labels.__getitem__,
+            )
+            selected_account_id = accounts[selected_pos].id
         else:
             st.info("No email accounts yet. Connect one below.")
             selected_account_id = None
@@ -199,8 +187,11 @@ with st.sidebar:
 
         st.caption(
             "Each button opens a new tab for provider sign-in. After you allow access, "
-            "return here and the account will appear in the list above."
+            "return here and refresh the list above to see the new account."
         )
+        if st.button("↻ Refresh accounts", key="refresh_accounts"):
+            _invalidate_accounts()
+            st.rerun()
 
 
         # Optional: advanced manual path for debug
@@ -226,6 +217,7 @@ with st.sidebar:
                             new_email,
                             new_refresh,
                         )
+                        _invalidate_accounts()
                         st.success("Account added.")
                         st.rerun()
                     except Exception as e:
@@ -235,17 +227,20 @@ with st.sidebar:
         st.markdown("---")
         st.header("Connection Settings")
 
-        fetch_limit = st.slider(
-            "Fetch latest N emails",
-            min_value=1,
-            max_value=50,
-            value=10,
-        )
+        # Inside a form, moving the slider doesn't rerun the script; only the
+        # submit button does.
+        with st.form("fetch_form", border=False):
+            fetch_limit = st.slider(
+                "Fetch latest N emails",
+                min_value=1,
+                max_value=50,
+                value=10,
+            )
 
-        connect_btn = st.button(
-            "🔌 Connect & Fetch",
-            disabled=(st.session_state.selected_account_id is None),
-        )
+            connect_btn = st.form_submit_button(
+                "🔌 Connect & Fetch",
+                disabled=(st.session_state.selected_account_id is None),
+            )
 
 # -------------------------------------------------------------------
 # Require login
@@ -257,40 +252,198 @@ if st.session_state.user_id is None:
 # -------------------------------------------------------------------
 # Connect + Fetch (Async) for selected account
 # -------------------------------------------------------------------
-async def _async_connect_and_fetch_account(
+# Messages per UID FETCH while streaming; small enough that parsing starts early
+STREAM_BATCH_SIZE = 10
+# Parsed inbox rows kept across fetches (all sessions, LRU)
+SUMMARY_CACHE_SIZE = 500
+# Full messages kept by _load_message; prefetch bookkeeping is bounded the same
+MESSAGE_CACHE_SIZE = 64
+
+
+@st.cache_resource
+def _parse_pool() -> Executor:
+    """
+    Process pool for EmailParser.parse: parsing is pure-Python CPU work, so
+    threads would just take turns on the GIL. One pool per server process.
+    Spawned (not forked) workers, since the Streamlit server is multi-threaded;
+    plain threads on Windows where process start-up is slow.
+    """
+    if os.name == "nt":
+        return ThreadPoolExecutor()
+    return ProcessPoolExecutor(
+        max_workers=os.cpu_count(), mp_context=multiprocessing.get_context("spawn")
+    )
+
+
+def _summarize(uid: int, headers: dict) -> dict:
+    return {
+        "uid": uid,
+        "subject": headers["subject"],
+        "from": headers["from"],
+        "to": headers["to"],
+        "date": headers["date"],
+    }
+
+
+@st.cache_resource
+def _summary_cache() -> OrderedDict:
+    """
+    (account_id, uidvalidity, uid) -> inbox row. A UID names the same message
+    for as long as the mailbox's UIDVALIDITY is unchanged, so re-fetching an
+    overlapping window (e.g. 10 -> 20) only parses the new ones; after a
+    mailbox rebuild the old rows are simply never hit again and age out.
+    Only touched from the IMAP pool's loop thread.
+    """
+    return OrderedDict()
+
+
+async def _fetch_summaries(
+    client: AsyncIMAPClient,
     account_id: int,
     limit: int,
+    cache: OrderedDict,
 ):
-    start = time.time()
+    # Only headers are downloaded for the inbox list; bodies are fetched and
+    # fully parsed when a message is selected. Header parsing stops at the blank
+    # line and costs microseconds, less than a round trip to the parse pool.
+    summaries = []
+    async for uid, raw in client.iter_latest(
+        limit, batch_size=STREAM_BATCH_SIZE, headers_only=True
+    ):
+        # Read per message: a reconnect between batches may re-SELECT
+        key = (account_id, client.uidvalidity, uid)
+        summary = cache.get(key)
+        if summary is None:
+            summary = _summarize(uid, EmailParser.parse_headers(raw))
+            cache[key] = summary
+        cache.move_to_end(key)
+        summaries.append(summary)
+
+    while len(cache) > SUMMARY_CACHE_SIZE:
+        cache.popitem(last=False)
+    return summaries
+
+
+def _parse_in_pool(raw: bytes) -> dict:
+    # Off the server's GIL, so one heavy MIME tree doesn't stall other sessions.
+    # Attachment bytes are never decoded or cached; _load_attachment fetches a
+    # single part when the user asks for it.
+    parse = partial(EmailParser.parse, decode_attachments=False)
+    try:
+        return _parse_pool().submit(parse, raw).result()
+    except BrokenProcessPool:
+        # A worker died (e.g. killed for memory); parse here and start a fresh pool next time
+        _parse_pool.clear()
+        return parse(raw)
 
-    user_id = st.session_state.user_id
-    provider, email_addr, access_token = get_access_token_for_account(user_id, account_id)
 
-    client = AsyncIMAPClient(
-        provider=provider,
-        email=email_addr,
-        credential=access_token,
-        use_oauth=True,
-    )
+def _checked(uidvalidity: Optional[int], fetch):
+    """
+    Wrap a with_client op so it only runs while INBOX still has the UIDVALIDITY
+    the inbox list was fetched under; after a change the same UID may name a
+    different message.
+    """
+    async def op(client: AsyncIMAPClient):
+        if client.uidvalidity != uidvalidity:
+            raise RuntimeError("The mailbox changed on the server; fetch the emails again.")
+        return await fetch(client)
 
-    await client.connect()
-    raw_list = await client.fetch_latest(limit)
-    await client.close()
+    return op
 
-    parsed = [EmailParser.parse(raw) for raw in raw_list]
 
-    end = time.time()
-    total_time = round(end - start, 2)
+@st.cache_resource
+def _prefetches() -> tuple[threading.Lock, OrderedDict]:
+    """
+    (user_id, account_id, uidvalidity, uid) -> Future of the raw body while a background
+    prefetch is outstanding, or None once _load_message has loaded it. LRU-bounded
+    like _load_message's cache, so messages it has evicted get prefetched again.
+    """
+    return threading.Lock(), OrderedDict()
+
+
+def _remember_prefetch(prefetches: OrderedDict, key: tuple, future) -> None:
+    # Caller holds the _prefetches() lock
+    prefetches[key] = future
+    prefetches.move_to_end(key)
+    while len(prefetches) > MESSAGE_CACHE_SIZE:
+        prefetches.popitem(last=False)
+
+
+def _prefetch_message(
+    user_id: int, account_id: int, uidvalidity: Optional[int], uid: int
+) -> None:
+    """Start downloading a message body on the IMAP pool's loop without waiting for it."""
+    lock, prefetches = _prefetches()
+    key = (user_id, account_id, uidvalidity, uid)
+    with lock:
+        if key in prefetches:
+            return
+        fetch = _checked(uidvalidity, lambda client: client.fetch_body(uid))
+        future = submit(with_client(user_id, account_id, fetch))
+        _remember_prefetch(prefetches, key, future)
+
+
+@st.cache_data(max_entries=MESSAGE_CACHE_SIZE, show_spinner=False)
+def _load_message(user_id: int, account_id: int, uidvalidity: Optional[int], uid: int) -> dict:
+    """Fetch and parse the full message on first view; later views are served from cache."""
+    lock, prefetches = _prefetches()
+    key = (user_id, account_id, uidvalidity, uid)
+    with lock:
+        future = prefetches.get(key)
+        _remember_prefetch(prefetches, key, None)
+
+    raw = None
+    if future is not None:
+        try:
+            # Usually already done; otherwise waits for the download in flight
+            raw = future.result()
+        except Exception:
+            # Failed prefetch; fetch it again below and let that error surface
+            pass
+    if raw is None:
+        fetch = _checked(uidvalidity, lambda client: client.fetch_body(uid))
+        raw = run_in_loop(with_client(user_id, account_id, fetch))
+    if raw is None:
+        raise RuntimeError("Message no longer exists on the server")
+    parsed = _parse_in_pool(raw)
+    return parsed
+
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def _load_raw_message(
+    user_id: int, account_id: int, uidvalidity: Optional[int], uid: int
+) -> bytes:
+    fetch = _checked(uidvalidity, lambda client: client.fetch_body(uid))
+    raw = run_in_loop(with_client(user_id, account_id, fetch))
+    return raw or b""
+
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def _load_attachment(
+    user_id: int,
+    account_id: int,
+    uidvalidity: Optional[int],
+    uid: int,
+    part_id: str,
+    encoding: str,
+) -> bytes:
+    fetch = _checked(uidvalidity, lambda client: client.fetch_part(uid, part_id))
+    raw = run_in_loop(with_client(user_id, account_id, fetch))
+    return EmailParser.decode_part(raw or b"", encoding)
 
-    st.session_state.parsed_messages = parsed
-    st.session_state.connected = True
-    st.session_state.selected_index = 0
-    st.session_state.connection_info = {
-        "provider": provider,
-        "email": email_addr,
-        "count": len(parsed),
-        "time": total_time,
-    }
+
+async def _async_connect_and_fetch_account(
+    user_id: int,
+    account_id: int,
+    limit: int,
+    cache: OrderedDict,
+):
+    # Runs on the IMAP pool's loop thread, so it must not touch st.session_state
+    async def fetch(client: AsyncIMAPClient):
+        summaries = await _fetch_summaries(client, account_id, limit, cache)
+        return client.provider, client.email, client.uidvalidity, summaries
+
+    return await with_client(user_id, account_id, fetch)
 
 
 def connect_and_fetch_selected_account(limit: int):
@@ -300,16 +453,34 @@ def connect_and_fetch_selected_account(limit: int):
         return
 
     try:
-        asyncio.run(
+        start = time.perf_counter()
+        provider, email_addr, uidvalidity, parsed = run_in_loop(
             _async_connect_and_fetch_account(
+                st.session_state.user_id,
                 account_id,
                 limit,
+                _summary_cache(),
             )
         )
-        info = st.session_state.connection_info
+        end = time.perf_counter()
+        total_time = round(end - start, 2)
+
+        st.session_state.parsed_messages = parsed
+        st.session_state.connected = True
+        st.session_state.selected_index = 0
+        st.session_state.pop("inbox_select", None)
+        st.session_state.connection_info = {
+            "account_id": account_id,
+            # Part of every cache key below that contains a UID
+            "uidvalidity": uidvalidity,
+            "provider": provider,
+            "email": email_addr,
+            "count": len(parsed),
+            "time": total_time,
+        }
         st.success(
-            f"Connected to **{info['provider']}** as **{info['email']}** — "
-            f"fetched {info['count']} emails in {info['time']} seconds."
+            f"Connected to **{provider}** as **{email_addr}** — "
+            f"fetched {len(parsed)} emails in {total_time} seconds."
         )
     except Exception as e:
         st.session_state.connected = False
@@ -324,6 +495,109 @@ if st.session_state.user_id is not None and "connect_btn" in locals():
 # -------------------------------------------------------------------
 # Main Layout: Email List + Tabs Viewer
 # -------------------------------------------------------------------
+@st.cache_data(max_entries=16, show_spinner=False)
+def _pdf_data_url(
+    account_id: int, uidvalidity: Optional[int], uid: int, part_id: str, _content: bytes
+) -> str:
+    # base64 of a multi-MB PDF is costly; encode once, not on every rerun.
+    # Keyed by the part's identity so the cache doesn't hash the bytes each time.
+    return EmailParser.data_url(_content, "application/pdf")
+
+
+_PILL_TEMPLATE = Template(
+    "<div class='conn-pill'><strong>$provider</strong> • $email • $count messages</div>"
+)
+
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def _summary_pill_html(provider: str, email_addr: str, count: int) -> str:
+    return _PILL_TEMPLATE.substitute(
+        provider=html.escape(provider.upper()),
+        email=html.escape(email_addr),
+        count=count,
+    )
+
+
+def _json_view(msg: dict) -> dict:
+    """
+    What the Raw JSON view shows: O(headers) instead of O(message). Bodies are
+    cut to the preview length and any attachment bytes are dropped.
+    """
+    limit = EmailParser.TEXT_PREVIEW_CHARS
+    view = {k: v for k, v in msg.items() if k not in ("text", "html", "attachments")}
+    view["html"] = msg.get("html", "")[:limit]
+    view["attachments"] = [
+        {k: v for k, v in att.items() if k != "content"}
+        for att in msg.get("attachments", [])
+    ]
+    return view
+
+
+@st.cache_data(max_entries=128, show_spinner=False)
+def _header_html(subject: str, sender: str, to: str, date: str) -> str:
+    # Escape to avoid invalid HTML tags from things like <email@domain>
+    return (
+        f"<div class='subject-line'>{html.escape(subject)}</div>"
+        f"<div class='email-meta'>From: {html.escape(sender)}<br>"
+        f"To: {html.escape(to)}<br>Date: {html.escape(date)}</div>"
+    )
+
+
+def _render_attachment(
+    attachment: dict, account_id: int, uidvalidity: Optional[int], msg_uid: int
+) -> None:
+    fn = attachment.get("filename") or "attachment"
+    mime_type = attachment.get("mime_type") or "application/octet-stream"
+
+    # Attachment bytes are only downloaded once the user asks for them
+    part_id = attachment["part_id"]
+    if not st.toggle("Load attachment", key=f"att_{account_id}_{msg_uid}_{part_id}"):
+        return
+
+    try:
+        with st.spinner(f"Downloading {fn}..."):
+            content = _load_attachment(
+                st.session_state.user_id,
+                account_id,
+                uidvalidity,
+                msg_uid,
+                part_id,
+                attachment["encoding"],
+            )
+    except Exception as e:
+        st.error(f"Failed to download {fn}: {e}")
+        return
+
+    st.download_button(
+        label=f"Download {fn}",
+        data=content,
+        file_name=fn,
+        mime=mime_type,
+    )
+
+    # Simple preview by type
+    if mime_type.startswith("image/"):
+        st.image(content, caption=fn, use_column_width=True)
+    elif mime_type == "application/pdf":
+        st.markdown(
+            f"""
+            <iframe src="{_pdf_data_url(account_id, uidvalidity, msg_uid, part_id, content)}"
+            width="100%" height="500px"></iframe>
+            """,
+            unsafe_allow_html=True,
+        )
+    elif mime_type.startswith("text/"):
+        # Only decode what the preview shows; the full file is in the download
+        st.code(content[:EmailParser.TEXT_PREVIEW_CHARS].decode("utf-8", errors="ignore"))
+    elif mime_type == "text/html":
+        st.markdown(
+            content.decode("utf-8", errors="ignore"),
+            unsafe_allow_html=True,
+        )
+    else:
+        st.info("Preview not available — download to view.")
+
+
 if not st.session_state.connected:
     st.info("Use the sidebar to select an account and fetch emails.")
 else:
@@ -332,24 +606,10 @@ else:
 
     # Connection summary pill
     with st.container():
-        st.markdown(
-            f"""
-            <div style="
-                padding: 0.45rem 0.9rem;
-                border-radius: 999px;
-                background-color: var(--secondary-background-color);
-                color: var(--text-color);
-                display: inline-block;
-                margin-bottom: 0.75rem;
-                font-size: 0.9rem;
-                box-shadow: 0 0 0 1px rgba(255,255,255,0.08), 0 2px 6px rgba(0,0,0,0.25);
-            ">
-                <strong>{info.get('provider','').upper()}</strong> • 
-                {info.get('email','')} • 
-                {info.get('count',0)} messages
-            </div>
-            """,
-            unsafe_allow_html=True,
+        st.html(
+            _summary_pill_html(
+                info.get("provider", ""), info.get("email", ""), info.get("count", 0)
+            )
         )
 
     col_list, col_view = st.columns([1, 2])
@@ -358,45 +618,68 @@ else:
     with col_list:
         st.subheader("Inbox")
 
-        display_items = []
-        for i, m in enumerate(parsed):
-            subj = m["subject"] or "(no subject)"
-            frm = m["from"] or "(unknown sender)"
-            display_items.append(f"{i+1}. {subj} — {frm}")
-
-        selected_label = st.selectbox("Select message", options=display_items)
-        selected_index = display_items.index(selected_label)
+        # Labels only change when a fetch replaces parsed_messages. Holding the
+        # list itself (not its id()) means a freed list's id can't be mistaken for it.
+        labels_for = st.session_state.get("_labels_for", (None, None))
+        if labels_for[0] is not parsed:
+            labels_for = (
+                parsed,
+                [
+                    f"{i+1}. {m['subject'] or '(no subject)'}"
+                    f" — {m['from'] or '(unknown sender)'}"
+                    for i, m in enumerate(parsed)
+                ],
+            )
+            st.session_state._labels_for = labels_for
+        message_labels = labels_for[1]
+
+        # Options are indices, so the widget returns the index directly;
+        # labels are only looked up for display.
+        selected_index = st.selectbox(
+            "Select message",
+            options=range(len(parsed)),
+            format_func=message_labels.__getitem__,
+            key="inbox_select",
+        )
+        if selected_index is None:
+            st.info("This mailbox is empty.")
+            st.stop()
         st.session_state.selected_index = selected_index
-        msg = parsed[selected_index]
 
     # -------- Email viewer (right) with tabs --------
     with col_view:
-        preview_start = time.time()
+        preview_start = time.perf_counter()
+
+        msg_uid = parsed[selected_index]["uid"]
+        try:
+            with st.spinner("Loading message..."):
+                msg = _load_message(
+                    st.session_state.user_id, info["account_id"], info["uidvalidity"], msg_uid
+                )
+        except Exception as e:
+            st.error(f"Failed to load message: {e}")
+            st.stop()
 
         subject = msg.get("subject") or "(no subject)"
         sender = msg.get("from") or "(unknown sender)"
         to = msg.get("to") or ""
         date = msg.get("date") or ""
 
-        # Escape to avoid invalid HTML tags from things like <email@domain>
-        subject_html = html.escape(subject)
-        sender_html = html.escape(sender)
-        to_html = html.escape(to)
-        date_html = html.escape(date)
-
-        st.markdown(
-            f"<div class='subject-line'>{subject_html}</div>",
-            unsafe_allow_html=True,
-        )
-        st.markdown(
-            f"<div class='email-meta'>From: {sender_html}<br>To: {to_html}<br>Date: {date_html}</div>",
-            unsafe_allow_html=True,
+        # st.html skips the markdown tokenizer that st.markdown runs first
+        st.html(_header_html(subject, sender, to, date))
+
+        # st.tabs runs every tab body on each rerun; a radio lets only the
+        # visible view execute (no attachment previews / JSON while on Overview).
+        active_view = st.radio(
+            "View",
+            ["Overview", "Plain Text", "HTML", "Attachments", "Raw JSON"],
+            horizontal=True,
+            key="active_tab",
+            label_visibility="collapsed",
         )
 
-        tabs = st.tabs(["Overview", "Plain Text", "HTML", "Attachments", "Raw JSON"])
-
-        # Overview tab
-        with tabs[0]:
+        # Overview
+        if active_view == "Overview":
             st.markdown("#### Summary")
             st.write(
                 {
@@ -409,12 +692,12 @@ else:
             )
 
         # Plain text
-        with tabs[1]:
+        elif active_view == "Plain Text":
             st.markdown("#### Plain Text Body")
-            st.code(msg.get("text", "")[:8000] or "(no plain text)")
+            st.code(msg.get("text_preview") or "(no plain text)")
 
         # HTML
-        with tabs[2]:
+        elif active_view == "HTML":
             st.markdown("#### HTML Body")
             if msg.get("html"):
                 st.markdown(msg["html"], unsafe_allow_html=True)
@@ -422,61 +705,59 @@ else:
                 st.info("No HTML body found.")
 
         # Attachments
-        with tabs[3]:
+        elif active_view == "Attachments":
             st.markdown("#### Attachments")
             if msg.get("attachments"):
                 for attachment in msg["attachments"]:
                     fn = attachment.get("filename") or "attachment"
                     size = attachment.get("size_kb", 0)
-                    content = attachment.get("content", b"")
-
-                    mime_type, _ = mimetypes.guess_type(fn)
-                    mime_type = mime_type or "application/octet-stream"
-
-                    st.write(f"📎 **{fn}** — {size} KB")
-                    st.download_button(
-                        label=f"Download {fn}",
-                        data=content,
-                        file_name=fn,
-                        mime=mime_type,
-                    )
-
-                    # Simple preview by type
-                    if mime_type.startswith("image/"):
-                        st.image(content, caption=fn, use_column_width=True)
-                    elif mime_type == "application/pdf":
-                        import base64
-
-                        base64_pdf = base64.b64encode(content).decode("utf-8")
-                        st.markdown(
-                            f"""
-                            <iframe src="data:application/pdf;base64,{base64_pdf}"
-                            width="100%" height="500px"></iframe>
-                            """,
-                            unsafe_allow_html=True,
-                        )
-                    elif mime_type.startswith("text/"):
-                        st.code(content.decode("utf-8", errors="ignore"))
-                    elif mime_type == "text/html":
-                        st.markdown(
-                            content.decode("utf-8", errors="ignore"),
-                            unsafe_allow_html=True,
-                        )
-                    else:
-                        st.info("Preview not available — download to view.")
+                    with st.expander(f"📎 {fn} — {size} KB"):
+                        _render_attachment(attachment, info["account_id"], info["uidvalidity"], msg_uid)
             else:
                 st.info("No attachments found.")
 
         # Raw JSON
-        with tabs[4]:
+        elif active_view == "Raw JSON":
             st.markdown("#### Raw Parsed JSON")
-            st.json(msg)
-
-        preview_time = round(time.time() - preview_start, 3)
-        st.caption(f"⏱ Email rendered in {preview_time} seconds")
+            st.json(_json_view(msg))
+            st.caption("Bodies are truncated and attachment bytes omitted.")
+            if st.toggle("Prepare .eml download", key=f"eml_{info['account_id']}_{msg_uid}"):
+                with st.spinner("Downloading message..."):
+                    raw_eml = _load_raw_message(
+                        st.session_state.user_id, info["account_id"], info["uidvalidity"], msg_uid
+                    )
+                st.download_button(
+                    label="Download raw message (.eml)",
+                    data=raw_eml,
+                    file_name=f"message-{msg_uid}.eml",
+                    mime="message/rfc822",
+                )
+
+        # Measure the first render of each message; switching views on the same
+        # message keeps showing that number instead of a cache-hit timing.
+        previewed = (info["account_id"], msg_uid)
+        if st.session_state.get("_last_previewed") != previewed:
+            st.session_state._last_previewed = previewed
+            st.session_state._preview_time = round(time.perf_counter() - preview_start, 3)
+        st.caption(f"⏱ Email rendered in {st.session_state._preview_time} seconds")
 
 # -------------------------------------------------------------------
 # Footer
 # -------------------------------------------------------------------
 st.markdown("---")
 st.caption("IMAP Viewer — Async IMAP + Multi-Account OAuth (Gmail & Outlook)")
+
+# -------------------------------------------------------------------
+# Prefetch neighbours of the selected message
+# -------------------------------------------------------------------
+# The downloads run on the IMAP pool's loop and this rerun doesn't wait for them;
+# _load_message picks the bodies up when the user moves to the next / previous one.
+if st.session_state.connected:
+    for neighbour in (selected_index + 1, selected_index - 1):
+        if 0 <= neighbour < len(parsed):
+            _prefetch_message(
+                st.session_state.user_id,
+                info["account_id"],
+                info["uidvalidity"],
+                parsed[neighbour]["uid"],
+            )
@@ -1,4 +1,6 @@
-from typing import List, Optional, Tuple
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple
 
 from sqlmodel import select
 
@@ -9,15 +11,40 @@ from src.auth import (
     decrypt_token,
 )
 from src.token_utils import (
-    refresh_gmail_access_token,
-    refresh_outlook_access_token,
+    ACCESS_TOKEN_EXPIRY_MARGIN,
+    refresh_gmail_access_token_with_expiry,
+    refresh_outlook_access_token_with_expiry,
 )
 
 
-def list_email_accounts_for_user(user_id: int) -> List[EmailAccount]:
+# Tokens still in use are renewed in the background this long before the
+# cache would treat them as stale, so fetches don't wait on the token endpoint
+REFRESH_AHEAD_SECONDS = 60
+
+# account_id -> (access_token, expires_at_epoch); shared by all sessions in this process
+_ACCESS_TOKEN_CACHE: Dict[int, Tuple[str, float]] = {}
+# One lock per account so concurrent fetches trigger a single refresh
+_REFRESH_LOCKS: Dict[int, threading.Lock] = {}
+# account_id -> (refresh_token_encrypted, decrypted refresh token)
+_REFRESH_TOKEN_CACHE: Dict[int, Tuple[str, str]] = {}
+# account_id -> time.time() of the last get_access_token_for_account call
+_LAST_USED: Dict[int, float] = {}
+_REFRESH_TIMERS: Dict[int, threading.Timer] = {}
+
+
+class AccountSummary(NamedTuple):
+    """What the account picker shows; no encrypted refresh token."""
+    id: int
+    provider: str
+    email_address: str
+
+
+def list_email_accounts_for_user(user_id: int) -> List[AccountSummary]:
     with get_session() as session:
-        stmt = select(EmailAccount).where(EmailAccount.user_id == user_id)
-        return list(session.exec(stmt))
+        stmt = select(
+            EmailAccount.id, EmailAccount.provider, EmailAccount.email_address
+        ).where(EmailAccount.user_id == user_id)
+        return [AccountSummary(*row) for row in session.exec(stmt)]
 
 
 def create_email_account_for_user(
@@ -38,8 +65,8 @@ def create_email_account_for_user(
 
     with get_session() as session:
         session.add(acc)
+        # The INSERT's RETURNING fills in acc.id; no refresh needed
         session.commit()
-        session.refresh(acc)
     return acc
 
 
@@ -52,12 +79,87 @@ def get_email_account_for_user(user_id: int, account_id: int) -> Optional[EmailA
         return session.exec(stmt).first()
 
 
+def _cached_access_token(account_id: int) -> Optional[str]:
+    entry = _ACCESS_TOKEN_CACHE.get(account_id)
+    if entry and entry[1] - time.time() > ACCESS_TOKEN_EXPIRY_MARGIN:
+        return entry[0]
+    return None
+
+
+def _refresh_token_for(acc: EmailAccount) -> str:
+    # Fernet decrypt is an HMAC check + AES per call; the stored value rarely
+    # changes, so remember the plaintext for as long as the ciphertext matches.
+    entry = _REFRESH_TOKEN_CACHE.get(acc.id)
+    if entry and entry[0] == acc.refresh_token_encrypted:
+        return entry[1]
+    refresh_token = decrypt_token(acc.refresh_token_encrypted)
+    _REFRESH_TOKEN_CACHE[acc.id] = (acc.refresh_token_encrypted, refresh_token)
+    return refresh_token
+
+
+def invalidate_access_token(account_id: int) -> None:
+    """Forget the cached access token, e.g. after the IMAP server rejected it."""
+    _ACCESS_TOKEN_CACHE.pop(account_id, None)
+
+
+def _refresh_access_token(acc: EmailAccount, force: bool = False) -> str:
+    with _REFRESH_LOCKS.setdefault(acc.id, threading.Lock()):
+        # Another caller may have refreshed while we waited for the lock
+        access_token = None if force else _cached_access_token(acc.id)
+        if access_token:
+            return access_token
+
+        refresh_token = _refresh_token_for(acc)
+
+        if acc.provider == "gmail":
+            result = refresh_gmail_access_token_with_expiry(refresh_token)
+        elif acc.provider == "outlook":
+            result = refresh_outlook_access_token_with_expiry(refresh_token)
+        else:
+            raise RuntimeError(f"Unsupported provider: {acc.provider}")
+
+        if not result:
+            raise RuntimeError("Failed to obtain access token from refresh token")
+
+        _ACCESS_TOKEN_CACHE[acc.id] = result
+        _schedule_refresh_ahead(acc, result[1])
+        return result[0]
+
+
+def _schedule_refresh_ahead(acc: EmailAccount, expires_at: float) -> None:
+    delay = expires_at - ACCESS_TOKEN_EXPIRY_MARGIN - REFRESH_AHEAD_SECONDS - time.time()
+    if delay <= 0:
+        return
+    old = _REFRESH_TIMERS.pop(acc.id, None)
+    if old is not None:
+        old.cancel()
+    timer = threading.Timer(delay, _refresh_ahead, args=(acc, time.time()))
+    timer.daemon = True
+    _REFRESH_TIMERS[acc.id] = timer
+    timer.start()
+
+
+def _refresh_ahead(acc: EmailAccount, refreshed_at: float) -> None:
+    # Only keep tokens warm for accounts that were used since the last refresh;
+    # idle ones just lapse and get refreshed on demand.
+    if _LAST_USED.get(acc.id, 0.0) < refreshed_at:
+        return
+    try:
+        _refresh_access_token(acc, force=True)
+    except Exception as e:
+        print(f"[accounts] Background token refresh failed for {acc.email_address}: {e}")
+
+
 def get_access_token_for_account(
     user_id: int,
     account_id: int,
 ) -> Tuple[str, str, str]:
     """
-    Resolve provider, email, and a fresh access token for the given account.
+    Resolve provider, email, and a valid access token for the given account.
+
+    The token is cached per account until shortly before it expires, and
+    renewed in the background while the account is in use, so most calls
+    don't hit the provider's token endpoint.
 
     Returns:
         (provider, email_address, access_token)
@@ -66,16 +168,6 @@ def get_access_token_for_account(
     if not acc:
         raise RuntimeError("Email account not found for current user")
 
-    refresh_token = decrypt_token(acc.refresh_token_encrypted)
-
-    if acc.provider == "gmail":
-        access_token = refresh_gmail_access_token(refresh_token)
-    elif acc.provider == "outlook":
-        access_token = refresh_outlook_access_token(refresh_token)
-    else:
-        raise RuntimeError(f"Unsupported provider: {acc.provider}")
-
-    if not access_token:
-        raise RuntimeError("Failed to obtain access token from refresh token")
-
+    _LAST_USED[acc.id] = time.time()
+    access_token = _cached_access_token(acc.id) or _refresh_access_token(acc)
     return acc.provider, acc.email_address, access_token
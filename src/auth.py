@@ -1,10 +1,11 @@
 import os
+from functools import lru_cache
 from datetime import datetime
 from typing import Optional
 
+from sqlalchemy import Index, event, func
 from sqlmodel import SQLModel, Field, Session, create_engine, select
 from passlib.context import CryptContext
-from cryptography.fernet import Fernet, InvalidToken
 
 # -------------------------------------------------------------------
 # DB setup
@@ -17,36 +18,72 @@ _project_root = os.path.dirname(os.path.dirname(_current_file))
 _default_db_path = os.path.join(_project_root, "app.db")
 
 DATABASE_URL = os.getenv("APP_DB_URL", f"sqlite:///{_default_db_path}")
-engine = create_engine(DATABASE_URL, echo=False)
+_is_sqlite = DATABASE_URL.startswith("sqlite")
+
+# Pooled connections are reused across sessions; Streamlit and FastAPI both
+# hand them to worker threads, hence check_same_thread=False for SQLite.
+engine = create_engine(
+    DATABASE_URL,
+    echo=False,
+    connect_args={"check_same_thread": False} if _is_sqlite else {},
+    pool_pre_ping=True,
+    pool_size=5,
+    max_overflow=10,
+)
+
+
+if _is_sqlite:
+    @event.listens_for(engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+        # WAL lets the Streamlit and FastAPI processes read while the other writes
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA cache_size=-20000")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute("PRAGMA mmap_size=268435456")
+        cursor.close()
 
 pwd_context = CryptContext(schemes=["pbkdf2_sha256"], deprecated="auto")
 
+# Verified against on unknown emails so a failed login takes as long as a wrong password
+_DUMMY_HASH = pwd_context.hash("x")
+
 # -------------------------------------------------------------------
 # Encryption setup (for refresh tokens)
 # -------------------------------------------------------------------
 
 FERNET_KEY = os.getenv("TOKEN_ENCRYPTION_KEY")
 
-if FERNET_KEY:
-    # Expecting a base64-encoded key
-    _fernet = Fernet(FERNET_KEY.encode("utf-8"))
-else:
+
+@lru_cache(maxsize=1)
+def _get_fernet():
+    # cryptography is only imported once a token is actually encrypted/decrypted,
+    # so login-only reruns (and the backend's startup) don't pay for it
+    from cryptography.fernet import Fernet
+
+    if FERNET_KEY:
+        # Expecting a base64-encoded key
+        return Fernet(FERNET_KEY.encode("utf-8"))
+
     # Ephemeral key: tokens will not be decryptable across restarts
-    _fernet = Fernet(Fernet.generate_key())
     print(
         "[WARN] TOKEN_ENCRYPTION_KEY is not set. "
         "Refresh tokens will be encrypted with an in-memory key only "
         "and will NOT be usable after a restart."
     )
+    return Fernet(Fernet.generate_key())
 
 
 def encrypt_token(raw: str) -> str:
-    return _fernet.encrypt(raw.encode("utf-8")).decode("utf-8")
+    return _get_fernet().encrypt(raw.encode("utf-8")).decode("utf-8")
 
 
 def decrypt_token(enc: str) -> str:
+    from cryptography.fernet import InvalidToken
+
     try:
-        return _fernet.decrypt(enc.encode("utf-8")).decode("utf-8")
+        return _get_fernet().decrypt(enc.encode("utf-8")).decode("utf-8")
     except InvalidToken:
         raise ValueError("Failed to decrypt stored token; check TOKEN_ENCRYPTION_KEY.")
 
@@ -55,6 +92,10 @@ def decrypt_token(enc: str) -> str:
 # Models
 # -------------------------------------------------------------------
 
+def _normalize_email(email: str) -> str:
+    return email.lower().strip()
+
+
 class User(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     email: str = Field(index=True, unique=True)
@@ -62,7 +103,15 @@ class User(SQLModel, table=True):
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
 
+# Case-insensitive uniqueness enforced by the DB, and an index for the
+# lower(email) lookups below (also covers rows saved before normalization)
+Index("ix_user_email_lower", func.lower(User.email), unique=True)
+
+
 class EmailAccount(SQLModel, table=True):
+    # get_email_account_for_user filters on both columns
+    __table_args__ = (Index("ix_ea_user_id_id", "user_id", "id"),)
+
     id: Optional[int] = Field(default=None, primary_key=True)
     user_id: int = Field(foreign_key="user.id", index=True)
     provider: str = Field(index=True)  # "gmail" or "outlook"
@@ -77,7 +126,8 @@ def create_db_and_tables() -> None:
 
 
 def get_session() -> Session:
-    return Session(engine)
+    # Objects stay loaded after commit, so returning them needs no refresh SELECT
+    return Session(engine, expire_on_commit=False)
 
 
 # -------------------------------------------------------------------
@@ -98,35 +148,38 @@ def verify_password(plain_password: str, password_hash: str) -> bool:
 
 def get_user_by_email(email: str) -> Optional[User]:
     with get_session() as session:
-        stmt = select(User).where(User.email == email.lower())
+        stmt = select(User).where(func.lower(User.email) == _normalize_email(email))
         return session.exec(stmt).first()
 
 
 def register_user(email: str, password: str) -> User:
-    email = email.lower().strip()
+    email = _normalize_email(email)
     if not email or not password:
         raise ValueError("Email and password are required")
 
-    existing = get_user_by_email(email)
-    if existing:
-        raise ValueError("A user with this email already exists")
-
     user = User(
         email=email,
         password_hash=hash_password(password),
     )
+    # Existence check and insert share one session / connection
     with get_session() as session:
+        stmt = select(User.id).where(func.lower(User.email) == email)
+        existing = session.exec(stmt).first()
+        if existing is not None:
+            raise ValueError("A user with this email already exists")
         session.add(user)
+        # The INSERT's RETURNING fills in user.id; no refresh needed
         session.commit()
-        session.refresh(user)
     return user
 
 
 def authenticate_user(email: str, password: str) -> Optional[User]:
-    email = email.lower().strip()
-    user = get_user_by_email(email)
-    if not user:
-        return None
-    if not verify_password(password, user.password_hash):
-        return None
-    return user
+    with get_session() as session:
+        stmt = select(User).where(func.lower(User.email) == _normalize_email(email))
+        user = session.exec(stmt).first()
+        if not user:
+            verify_password(password, _DUMMY_HASH)
+            return None
+        if not verify_password(password, user.password_hash):
+            return None
+        return user
@@ -1,11 +1,18 @@
 import os
 import urllib.parse
 import secrets
-from typing import Dict
-
-import requests
-from fastapi import FastAPI, HTTPException, Query
-from fastapi.responses import RedirectResponse, HTMLResponse
+import threading
+import time
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from typing import Optional
+
+import httpx
+import orjson
+from cachetools import TTLCache
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import RedirectResponse, HTMLResponse, ORJSONResponse
 from dotenv import load_dotenv
 
 # Load env BEFORE importing anything that uses it
@@ -13,16 +20,100 @@ load_dotenv()
 
 from src.auth import get_session, User
 from src.accounts import create_email_account_for_user
-from src.token_utils import get_gmail_email, get_outlook_email_from_access_token
+from src.http_client import aclose_client, get_client
+from src.token_utils import get_gmail_email_async, get_outlook_email_from_access_token
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # The shared AsyncClient for the token endpoints opens lazily; close it on shutdown
+    yield
+    await aclose_client()
+
+
+app = FastAPI(
+    title="IMAP Backend OAuth Service",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
+
 
-app = FastAPI(title="IMAP Backend OAuth Service")
+@app.middleware("http")
+async def no_store_oauth_responses(request: Request, call_next):
+    # RFC 6749 5.1: nothing that carries state / identity may be cached, and
+    # Back shouldn't replay a callback URL from the browser cache
+    response = await call_next(request)
+    if request.url.path.startswith("/oauth/"):
+        response.headers["Cache-Control"] = "no-store"
+        response.headers["Pragma"] = "no-cache"
+    return response
 
 import logging
 logging.getLogger("uvicorn.access").disabled = True
 
 # ----------------- Common helpers -----------------
 
-STATE_STORE: Dict[str, int] = {}  # state -> user_id (dev-only, in-memory)
+# state -> user_id (in-memory). Abandoned flows expire after 10 minutes instead
+# of piling up; the lock covers the threadpool'd /start handlers.
+STATE_TTL_SECONDS = 600
+STATE_BYTES = 16
+# token_urlsafe(16) is always 22 characters; anything else can't be in the store
+STATE_LENGTH = len(secrets.token_urlsafe(STATE_BYTES))
+STATE_STORE: "TTLCache[str, int]" = TTLCache(maxsize=10_000, ttl=STATE_TTL_SECONDS)
+_STATE_LOCK = threading.Lock()
+
+
+def save_state(state: str, user_id: int) -> None:
+    with _STATE_LOCK:
+        STATE_STORE[state] = user_id
+
+
+def consume_state(state: str) -> Optional[int]:
+    """Pop the user_id for a state; None if unknown, expired or already used."""
+    # Junk states are turned away without hashing them or taking the lock
+    if len(state) != STATE_LENGTH:
+        return None
+    with _STATE_LOCK:
+        return STATE_STORE.pop(state, None)
+
+
+class RateLimiter:
+    """
+    Fixed-window counter per key (user_id or client IP). Raises 429 with
+    Retry-After once `limit` requests were seen in the current window.
+    In-process only, like STATE_STORE.
+    """
+
+    def __init__(self, limit: int, window_seconds: int = 60):
+        self.limit = limit
+        self.window = window_seconds
+        # key -> (window_start, count); idle keys drop out after one window
+        self._hits: "TTLCache[str, tuple]" = TTLCache(maxsize=10_000, ttl=window_seconds)
+        self._lock = threading.Lock()
+
+    def hit(self, key: str) -> None:
+        now = time.monotonic()
+        with self._lock:
+            start, count = self._hits.get(key, (now, 0))
+            if now - start >= self.window:
+                start, count = now, 0
+            if count >= self.limit:
+                retry_after = int(self.window - (now - start)) + 1
+                raise HTTPException(
+                    status_code=429,
+                    detail="Too many requests",
+                    headers={"Retry-After": str(retry_after)},
+                )
+            self._hits[key] = (start, count + 1)
+
+
+# /start is keyed by user_id, callbacks (no user until the state is consumed) by IP
+START_LIMITER = RateLimiter(limit=10)
+CALLBACK_LIMITER = RateLimiter(limit=30)
+
+
+def client_ip(request: Request) -> str:
+    return request.client.host if request.client else "unknown"
 
 
 def get_backend_base_url() -> str:
@@ -43,6 +134,28 @@ def get_gmail_redirect_uri() -> str:
     )
 
 
+@lru_cache(maxsize=8)
+def gmail_start_prefix(client_id: str, redirect_uri: str) -> str:
+    """
+    Consent URL up to and including "state=". The inputs come from env vars,
+    so a changed config simply misses the cache.
+    """
+    params = {
+        "client_id": client_id,
+        "redirect_uri": redirect_uri,
+        "response_type": "code",
+        "scope": "https://mail.google.com/",
+        "access_type": "offline",
+        "prompt": "consent",
+    }
+    return (
+        GMAIL_AUTH_ENDPOINT
+        + "?"
+        + urllib.parse.urlencode(params, quote_via=urllib.parse.quote)
+        + "&state="
+    )
+
+
 @app.get("/health", response_class=HTMLResponse)
 def health() -> str:
     return "<h3>Backend is running ✅</h3>"
@@ -51,6 +164,8 @@ def health() -> str:
 @app.get("/oauth/google/start")
 def oauth_google_start(user_id: int = Query(..., description="App user ID")):
     """Start Gmail OAuth for the given app user."""
+    START_LIMITER.hit(str(user_id))
+
     client_id = os.getenv("GMAIL_CLIENT_ID")
     if not client_id:
         raise HTTPException(status_code=500, detail="GMAIL_CLIENT_ID not configured")
@@ -61,32 +176,22 @@ def oauth_google_start(user_id: int = Query(..., description="App user ID")):
         if user is None:
             raise HTTPException(status_code=400, detail="Unknown user_id")
 
-    state = secrets.token_urlsafe(16)
-    STATE_STORE[state] = user_id
+    state = secrets.token_urlsafe(STATE_BYTES)
+    save_state(state, user_id)
 
-    params = {
-        "client_id": client_id,
-        "redirect_uri": get_gmail_redirect_uri(),
-        "response_type": "code",
-        "scope": "https://mail.google.com/",
-        "access_type": "offline",
-        "prompt": "consent",
-        "state": state,
-    }
-
-    auth_url = GMAIL_AUTH_ENDPOINT + "?" + urllib.parse.urlencode(
-        params, quote_via=urllib.parse.quote
-    )
+    # token_urlsafe output needs no percent-encoding
+    auth_url = gmail_start_prefix(client_id, get_gmail_redirect_uri()) + state
     return RedirectResponse(auth_url, status_code=302)
 
 
 @app.get("/oauth/google/callback", response_class=HTMLResponse)
-def oauth_google_callback(code: str, state: str):
+async def oauth_google_callback(request: Request, code: str, state: str):
     """Gmail redirects here after user consents."""
-    if state not in STATE_STORE:
-        raise HTTPException(status_code=400, detail="Invalid or expired state")
+    CALLBACK_LIMITER.hit(client_ip(request))
 
-    user_id = STATE_STORE.pop(state)
+    user_id = consume_state(state)
+    if user_id is None:
+        raise HTTPException(status_code=400, detail="Invalid or expired state")
 
     client_id = os.getenv("GMAIL_CLIENT_ID")
     client_secret = os.getenv("GMAIL_CLIENT_SECRET")
@@ -104,8 +209,9 @@ def oauth_google_callback(code: str, state: str):
     }
 
     try:
-        resp = requests.post(GMAIL_TOKEN_ENDPOINT, data=data, timeout=10)
-    except requests.RequestException as e:
+        http = await get_client()
+        resp = await http.post(GMAIL_TOKEN_ENDPOINT, data=data)
+    except httpx.HTTPError as e:
         raise HTTPException(status_code=502, detail=f"Gmail token request failed: {e}")
 
     if resp.status_code != 200:
@@ -113,7 +219,7 @@ def oauth_google_callback(code: str, state: str):
             status_code=502, detail=f"Gmail token exchange failed: {resp.text}"
         )
 
-    body = resp.json()
+    body = orjson.loads(resp.content)
     access_token = body.get("access_token")
     refresh_token = body.get("refresh_token")
 
@@ -128,14 +234,16 @@ def oauth_google_callback(code: str, state: str):
         """
         return HTMLResponse(content=html, status_code=200)
 
-    email_addr = get_gmail_email(access_token or "")
+    email_addr = await get_gmail_email_async(access_token or "", http)
     if not email_addr:
         raise HTTPException(
             status_code=502, detail="Could not determine Gmail email address from token"
         )
 
     try:
-        create_email_account_for_user(
+        # DB write + token encryption are blocking; keep them off the event loop
+        await run_in_threadpool(
+            create_email_account_for_user,
             user_id=user_id,
             provider="gmail",
             email_address=email_addr,
@@ -175,9 +283,35 @@ def get_outlook_redirect_uri() -> str:
     )
 
 
+@lru_cache(maxsize=8)
+def outlook_start_prefix(client_id: str, tenant: str, redirect_uri: str) -> str:
+    """Consent URL up to and including "state=" (see gmail_start_prefix)."""
+    scopes = (
+        "offline_access "
+        "https://outlook.office.com/IMAP.AccessAsUser.All "
+        "https://graph.microsoft.com/User.Read"
+    )
+
+    params = {
+        "client_id": client_id,
+        "response_type": "code",
+        "redirect_uri": redirect_uri,
+        "response_mode": "query",
+        "scope": scopes,
+    }
+    return (
+        f"{OUTLOOK_AUTH_BASE}/{tenant}{OUTLOOK_AUTH_PATH}"
+        + "?"
+        + urllib.parse.urlencode(params, quote_via=urllib.parse.quote)
+        + "&state="
+    )
+
+
 @app.get("/oauth/outlook/start")
 def oauth_outlook_start(user_id: int = Query(..., description="App user ID")):
     """Start Outlook OAuth for the given app user."""
+    START_LIMITER.hit(str(user_id))
+
     client_id = os.getenv("OUTLOOK_CLIENT_ID")
     if not client_id:
         raise HTTPException(status_code=500, detail="OUTLOOK_CLIENT_ID not configured")
@@ -188,40 +322,22 @@ def oauth_outlook_start(user_id: int = Query(..., description="App user ID")):
         if user is None:
             raise HTTPException(status_code=400, detail="Unknown user_id")
 
-    tenant = get_outlook_tenant()
-    auth_endpoint = f"{OUTLOOK_AUTH_BASE}/{tenant}{OUTLOOK_AUTH_PATH}"
-
-    state = secrets.token_urlsafe(16)
-    STATE_STORE[state] = user_id
-
-    scopes = (
-        "offline_access "
-        "https://outlook.office.com/IMAP.AccessAsUser.All "
-        "https://graph.microsoft.com/User.Read"
-    )
-
-    params = {
-        "client_id": client_id,
-        "response_type": "code",
-        "redirect_uri": get_outlook_redirect_uri(),
-        "response_mode": "query",
-        "scope": scopes,
-        "state": state,
-    }
+    state = secrets.token_urlsafe(STATE_BYTES)
+    save_state(state, user_id)
 
-    auth_url = auth_endpoint + "?" + urllib.parse.urlencode(
-        params, quote_via=urllib.parse.quote
-    )
-    return RedirectResponse(auth_url, status_code=302)
+    # token_urlsafe output needs no percent-encoding
+    prefix = outlook_start_prefix(client_id, get_outlook_tenant(), get_outlook_redirect_uri())
+    return RedirectResponse(prefix + state, status_code=302)
 
 
 @app.get("/oauth/outlook/callback", response_class=HTMLResponse)
-def oauth_outlook_callback(code: str, state: str):
+async def oauth_outlook_callback(request: Request, code: str, state: str):
     """Microsoft redirects here after user consents."""
-    if state not in STATE_STORE:
-        raise HTTPException(status_code=400, detail="Invalid or expired state")
+    CALLBACK_LIMITER.hit(client_ip(request))
 
-    user_id = STATE_STORE.pop(state)
+    user_id = consume_state(state)
+    if user_id is None:
+        raise HTTPException(status_code=400, detail="Invalid or expired state")
 
     client_id = os.getenv("OUTLOOK_CLIENT_ID")
     client_secret = os.getenv("OUTLOOK_CLIENT_SECRET")
@@ -249,8 +365,9 @@ def oauth_outlook_callback(code: str, state: str):
     }
 
     try:
-        resp = requests.post(token_endpoint, data=data, timeout=10)
-    except requests.RequestException as e:
+        http = await get_client()
+        resp = await http.post(token_endpoint, data=data)
+    except httpx.HTTPError as e:
         raise HTTPException(status_code=502, detail=f"Outlook token request failed: {e}")
 
     if resp.status_code != 200:
@@ -258,7 +375,7 @@ def oauth_outlook_callback(code: str, state: str):
             status_code=502, detail=f"Outlook token exchange failed: {resp.text}"
         )
 
-    body = resp.json()
+    body = orjson.loads(resp.content)
     access_token = body.get("access_token")
     refresh_token = body.get("refresh_token")
 
@@ -282,7 +399,9 @@ def oauth_outlook_callback(code: str, state: str):
         )
 
     try:
-        create_email_account_for_user(
+        # DB write + token encryption are blocking; keep them off the event loop
+        await run_in_threadpool(
+            create_email_account_for_user,
             user_id=user_id,
             provider="outlook",
             email_address=email_addr,
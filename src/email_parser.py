@@ -1,64 +1,139 @@
-import email
-from email.header import decode_header
+import base64
+import mimetypes
+import quopri
+from email import policy
+from email.parser import BytesHeaderParser, BytesParser
+
+# policy.default decodes RFC 2047 headers and RFC 2231 filenames on access,
+# so headers come back as plain text without a decode_header pass
+_PARSER = BytesParser(policy=policy.default)
+_HEADER_PARSER = BytesHeaderParser(policy=policy.default)
 
 
 class EmailParser:
 
+    # Length of the plain-text preview computed once at parse time
+    TEXT_PREVIEW_CHARS = 8000
+
+    @staticmethod
+    def iter_sections(part, section="", is_message=True):
+        """
+        Walk the MIME tree in msg.walk() order, yielding (section, part) where
+        section is the IMAP BODY[<section>] number of the part (RFC 3501 6.4.5).
+        Multipart containers get their own number, or "" at the top level.
+        """
+        if part.get_content_type() == "message/rfc822" and part.is_multipart():
+            yield section, part
+            yield from EmailParser.iter_sections(part.get_payload(0), section, True)
+        elif not part.is_multipart():
+            # A non-multipart message's body is part 1 of that message
+            yield (f"{section}.1" if section else "1") if is_message else section, part
+        else:
+            yield section, part
+            for i, child in enumerate(part.get_payload(), 1):
+                yield from EmailParser.iter_sections(
+                    child, f"{section}.{i}" if section else str(i), False
+                )
+
+    @staticmethod
+    def decode_part(payload, encoding):
+        """Undo Content-Transfer-Encoding on a body part fetched via BODY[<section>]."""
+        encoding = (encoding or "").strip().lower()
+        if encoding == "base64":
+            return base64.b64decode(payload)
+        if encoding == "quoted-printable":
+            return quopri.decodestring(payload)
+        return payload
+
+    @staticmethod
+    def data_url(content, mime_type):
+        """Inline data: URL for decoded part bytes, e.g. to preview a PDF in an iframe."""
+        return f"data:{mime_type};base64," + base64.b64encode(content).decode("ascii")
+
+    @staticmethod
+    def parse_headers(raw_bytes):
+        """
+        Just the fields the inbox list shows. Stops at the blank line after the
+        headers, so no body is decoded and no MIME tree is built.
+        """
+        msg = _HEADER_PARSER.parsebytes(raw_bytes)
+        return EmailParser.header_fields(msg)
+
     @staticmethod
-    def decode_mime(value):
-        if not value: return ""
-        parts = decode_header(value)
-        decoded = ""
-        for text, charset in parts:
-            if isinstance(text, bytes):
-                decoded += text.decode(charset or "utf-8", errors="ignore")
-            else:
-                decoded += text
-        return decoded
+    def header_fields(msg):
+        # str() so plain strings (not header objects) end up in caches / session
+        date = msg.get("Date")
+        return {
+            "subject": str(msg.get("Subject") or ""),
+            "from": str(msg.get("From") or ""),
+            "to": str(msg.get("To") or ""),
+            "date": str(date) if date is not None else None,
+        }
+
+    @staticmethod
+    def encoded_size(part):
+        """
+        Approximate decoded size of a part from its still-encoded payload,
+        without allocating the decoded bytes.
+        """
+        payload = part.get_payload()
+        if not isinstance(payload, str):
+            return 0
+        if str(part.get("Content-Transfer-Encoding", "")).strip().lower() == "base64":
+            data_len = len(payload) - payload.count("\n") - payload.count("\r")
+            return data_len * 3 // 4 - payload.count("=")
+        return len(payload)
 
     @staticmethod
-    def parse(raw_bytes):
-        msg = email.message_from_bytes(raw_bytes)
-
-        parsed = {
-            "subject": EmailParser.decode_mime(msg.get("Subject")),
-            "from": EmailParser.decode_mime(msg.get("From")),
-            "to": EmailParser.decode_mime(msg.get("To")),
-            "date": msg.get("Date"),
+    def parse(raw_bytes, *, decode_attachments=True):
+        """
+        With decode_attachments=False, attachments carry metadata only: no
+        "content" key, and size_kb is estimated from the encoded payload.
+        """
+        msg = _PARSER.parsebytes(raw_bytes)
+
+        parsed = EmailParser.header_fields(msg)
+        parsed.update({
             "text": "",
             "html": "",
             "attachments": []
-        }
+        })
 
-        for part in msg.walk():
+        # Collect raw bytes per part and decode once at the end; repeated str +=
+        # copies the whole body so far for every part
+        text_parts = []
+        html_parts = []
+
+        for section, part in EmailParser.iter_sections(msg):
             ctype = part.get_content_type()
             disp = str(part.get_content_disposition())
 
-            if ctype == "text/plain" and "attachment" not in disp:
-                payload = part.get_payload(decode=True)
-                if payload is None:
-                    continue
-                if isinstance(payload, bytes):
-                    parsed["text"] += payload.decode("utf-8", errors="ignore")
-                elif isinstance(payload, str):
-                    parsed["text"] += payload
-
-            elif ctype == "text/html" and "attachment" not in disp:
+            if ctype in ("text/plain", "text/html") and "attachment" not in disp:
                 payload = part.get_payload(decode=True)
                 if payload is None:
                     continue
-                if isinstance(payload, bytes):
-                    parsed["html"] += payload.decode("utf-8", errors="ignore")
-                elif isinstance(payload, str):
-                    parsed["html"] += payload
+                if isinstance(payload, str):
+                    payload = payload.encode("utf-8", errors="ignore")
+                (text_parts if ctype == "text/plain" else html_parts).append(payload)
 
             elif disp == "attachment":
-                filename = EmailParser.decode_mime(part.get_filename())
-                content = part.get_payload(decode=True) or b""
-                parsed["attachments"].append({
+                filename = part.get_filename() or ""
+                attachment = {
                     "filename": filename,
-                    "size_kb": round(len(content) / 1024, 2),
-                    "content": content
-                })
+                    "mime_type": mimetypes.guess_type(filename)[0] or part.get_content_type(),
+                    # enough to re-fetch just this part later (BODY.PEEK[part_id])
+                    "part_id": section,
+                    "encoding": str(part.get("Content-Transfer-Encoding", "")).strip().lower(),
+                }
+                if decode_attachments:
+                    content = part.get_payload(decode=True) or b""
+                    attachment["size_kb"] = round(len(content) / 1024, 2)
+                    attachment["content"] = content
+                else:
+                    attachment["size_kb"] = round(EmailParser.encoded_size(part) / 1024, 2)
+                parsed["attachments"].append(attachment)
 
+        parsed["text"] = b"".join(text_parts).decode("utf-8", errors="ignore")
+        parsed["html"] = b"".join(html_parts).decode("utf-8", errors="ignore")
+        parsed["text_preview"] = parsed["text"][:EmailParser.TEXT_PREVIEW_CHARS]
         return parsed
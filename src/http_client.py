@@ -0,0 +1,50 @@
+# src/http_client.py
+
+import asyncio
+import weakref
+
+import httpx
+
+try:
+    import h2  # noqa: F401  (optional; lets httpx speak HTTP/2)
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
+
+TIMEOUT = 10.0
+# httpx drops idle connections after 5s by default, so a refresh a minute after
+# the last one paid DNS + TCP + TLS again. Keep them for 60s like a browser would.
+KEEPALIVE_EXPIRY = 60.0
+LIMITS = httpx.Limits(
+    max_connections=100,
+    max_keepalive_connections=20,
+    keepalive_expiry=KEEPALIVE_EXPIRY,
+)
+
+# Shared pools, so repeated token / profile calls to Google and Microsoft reuse
+# keep-alive (HTTP/2 if available) connections instead of a TLS handshake each.
+
+# For blocking callers: Streamlit, token refresh threads, CLI scripts
+sync_client = httpx.Client(http2=HTTP2, timeout=TIMEOUT, limits=LIMITS)
+
+# httpx's async pool is bound to the loop that opened it, so one client per loop
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+async def get_client() -> httpx.AsyncClient:
+    """Process-wide AsyncClient for the running event loop, created on first use."""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(http2=HTTP2, timeout=TIMEOUT, limits=LIMITS)
+        _async_clients[loop] = client
+    return client
+
+
+async def aclose_client() -> None:
+    """Close the running loop's client, e.g. from FastAPI's lifespan shutdown."""
+    client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
@@ -1,111 +1,453 @@
 # src/imap_client.py
 
-import imaplib
 import asyncio
-from typing import List, Optional, Any, Callable
+import re
+import time
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Any, Tuple
+
+import aioimaplib
+
+
+class IMAPCommandError(Exception):
+    """The server answered NO / BAD to a command."""
+
+
+class IMAPAuthError(IMAPCommandError):
+    """Login was rejected, e.g. because the access token expired or was revoked."""
+
+
+# Errors that mean the connection is unusable and should be dropped / reopened
+IMAP_ERRORS = (
+    IMAPCommandError,
+    aioimaplib.Abort,
+    aioimaplib.CommandTimeout,
+    asyncio.TimeoutError,
+    OSError,
+)
+
+_UID_RE = re.compile(rb"UID (\d+)")
+_UIDVALIDITY_RE = re.compile(rb"UIDVALIDITY (\d+)")
+_FETCH_RE = re.compile(rb"\d+ FETCH \(")
+# An atom, optionally followed by a section spec and partial range, e.g. BODY[1.MIME]<0>
+_ATOM_RE = re.compile(rb'[^ ()"\[{]+(?:\[[^\]]*\])?(?:<\d+>)?')
+
+
+def _parse_fetch_lines(lines: List[Any]) -> List[Tuple[int, bytes]]:
+    """
+    (uid, literal) pairs from a UID FETCH response. aioimaplib returns each
+    literal as a bytearray line; the UID is on the line before it
+    (b"12 FETCH (UID 42 BODY[] {123}") or, on some servers, the line after (b" UID 42)").
+    """
+    emails: List[Tuple[int, bytes]] = []
+    prev: bytes = b""
+    uid_after_literal = False
+    for line in lines:
+        if isinstance(line, bytearray):
+            match = _UID_RE.search(prev)
+            emails.append((int(match.group(1)) if match else 0, bytes(line)))
+            uid_after_literal = match is None
+            continue
+        if uid_after_literal:
+            match = _UID_RE.search(line)
+            if match:
+                emails[-1] = (int(match.group(1)), emails[-1][1])
+            uid_after_literal = False
+        prev = line
+    return emails
+
+
+def _parse_uidvalidity(lines: List[Any]) -> Optional[int]:
+    """UIDVALIDITY from a SELECT response (b"OK [UIDVALIDITY 3857529045] UIDs valid")."""
+    for line in lines:
+        match = _UIDVALIDITY_RE.search(line)
+        if match:
+            return int(match.group(1))
+    return None
+
+
+def _parse_list(data: bytes, pos: int) -> Tuple[List[Any], int]:
+    """
+    Parse the parenthesized list starting at data[pos] into nested Python
+    lists of bytes (NIL -> None). Literals must be inlined as {n} CRLF <bytes>.
+    """
+    items: List[Any] = []
+    pos += 1
+    while pos < len(data):
+        c = data[pos]
+        if c == 0x20:  # space
+            pos += 1
+        elif c == 0x28:  # (
+            item, pos = _parse_list(data, pos)
+            items.append(item)
+        elif c == 0x29:  # )
+            return items, pos + 1
+        elif c == 0x22:  # quoted string
+            out = bytearray()
+            pos += 1
+            while data[pos] != 0x22:
+                if data[pos] == 0x5C:  # backslash escape
+                    pos += 1
+                out.append(data[pos])
+                pos += 1
+            items.append(bytes(out))
+            pos += 1
+        elif c == 0x7B:  # {n}\r\n literal
+            close = data.index(b"}", pos)
+            start = close + 3
+            end = start + int(data[pos + 1:close])
+            items.append(data[start:end])
+            pos = end
+        else:
+            match = _ATOM_RE.match(data, pos)
+            if match is None:
+                raise ValueError(f"Unexpected byte in IMAP response: {data[pos:pos + 20]!r}")
+            atom = match.group()
+            items.append(None if atom.upper() == b"NIL" else atom)
+            pos = match.end()
+    raise ValueError("Unterminated list in IMAP response")
+
+
+def _iter_fetch_responses(lines: List[Any]) -> Iterator[Dict[bytes, Any]]:
+    """
+    Each untagged FETCH response as {ITEM NAME: value}, e.g.
+    {b"UID": b"42", b"BODYSTRUCTURE": [...], b"BODY[1.MIME]": b"..."}.
+    """
+    def items(buf: bytearray) -> Dict[bytes, Any]:
+        values, _ = _parse_list(bytes(buf), buf.index(b"("))
+        return {name.upper(): value for name, value in zip(values[::2], values[1::2])}
+
+    buf: Optional[bytearray] = None
+    for line in lines:
+        if isinstance(line, bytearray):
+            # Literal; the line before it ended with {n}
+            if buf is not None:
+                buf += b"\r\n" + line
+        elif _FETCH_RE.match(line):
+            if buf is not None:
+                yield items(buf)
+            buf = bytearray(line)
+        elif buf is not None:
+            buf += line
+    if buf is not None:
+        yield items(buf)
+
+
+# ---------- BODYSTRUCTURE (RFC 3501 7.4.2) ----------
+
+def _is_multipart(node: List[Any]) -> bool:
+    return isinstance(node[0], list)
+
+
+def _children(node: List[Any]) -> List[List[Any]]:
+    # Child parts come first, then the subtype string and extension data
+    i = 0
+    while isinstance(node[i], list):
+        i += 1
+    return node[:i]
+
+
+def _boundary(node: List[Any]) -> bytes:
+    params = node[len(_children(node)) + 1]
+    for name, value in zip(params[::2], params[1::2]):
+        if name.lower() == b"boundary":
+            return value
+    raise ValueError("multipart part without a boundary")
+
+
+def _is_inline_text(node: List[Any]) -> bool:
+    if node[0].lower() != b"text" or node[1].lower() not in (b"plain", b"html"):
+        return False
+    # text/* leaves: type subtype params id desc encoding size lines md5 disposition
+    disposition = node[9] if len(node) > 9 else None
+    return not (disposition and disposition[0].lower() == b"attachment")
+
+
+def _sub(section: str, i: int) -> str:
+    return f"{section}.{i}" if section else str(i)
+
+
+def _wanted_sections(node: List[Any], section: str = "") -> Iterator[str]:
+    """Headers of every part, but bodies of inline text parts only."""
+    yield f"{section}.MIME" if section else "HEADER"
+    if _is_multipart(node):
+        for i, child in enumerate(_children(node), 1):
+            yield from _wanted_sections(child, _sub(section, i))
+    elif _is_inline_text(node):
+        yield section or "TEXT"
+
+
+def _assemble(node: List[Any], parts: Dict[str, bytes], section: str = "") -> bytes:
+    """
+    Rebuild a MIME message from the sections fetched for _wanted_sections().
+    Parts whose body was skipped keep their headers and an empty body.
+    """
+    header = parts.get(f"{section}.MIME" if section else "HEADER") or b""
+    if not _is_multipart(node):
+        return header + (parts.get(section or "TEXT") or b"")
+    delimiter = b"--" + _boundary(node)
+    body = b"".join(
+        delimiter + b"\r\n" + _assemble(child, parts, _sub(section, i)) + b"\r\n"
+        for i, child in enumerate(_children(node), 1)
+    )
+    return header + body + delimiter + b"--\r\n"
 
 
 class AsyncIMAPClient:
     """
-    Fully async IMAP client using asyncio.to_thread around imaplib.IMAP4_SSL.
+    Fully async IMAP client on top of aioimaplib (native asyncio, no threads).
 
     - Supports Gmail + Outlook via XOAUTH2 (Bearer tokens) or password (if use_oauth=False).
-    - Uses an asyncio.Lock to ensure a single connection isn't used concurrently.
+    - Single commands can be issued concurrently; aioimaplib queues them on the
+      connection. Multi-command sequences (login, SEARCH + FETCH) hold a lock.
     """
 
     GMAIL_IMAP = "imap.gmail.com"
     OUTLOOK_IMAP = "outlook.office365.com"
 
+    # Seconds to wait for the server greeting or a command's tagged response
+    TIMEOUT = 30
+
+    # Max UIDs per FETCH command; larger batches give diminishing returns
+    FETCH_BATCH_SIZE = 100
+
+    # BODY.PEEK[] returns the same bytes as RFC822 without setting \Seen
+    FULL_ITEMS = "(BODY.PEEK[])"
+    # Just enough to render an inbox row; a few hundred bytes per message
+    HEADER_ITEMS = "(BODY.PEEK[HEADER.FIELDS (SUBJECT FROM TO DATE)])"
+
     def __init__(self, provider: str, email: str, credential: str, use_oauth: bool = True):
         self.provider = provider.lower()
         self.email = email
         self.credential = credential
         self.use_oauth = use_oauth
-        self._imap: Optional[imaplib.IMAP4_SSL] = None
+        self._imap: Optional[aioimaplib.IMAP4_SSL] = None
+        # True once logged in and INBOX is selected
+        self._ready = False
         self._lock = asyncio.Lock()
+        # time.time() of the last command, so pooled callers can tell if a NOOP is due
+        self.last_used = 0.0
+        # INBOX's UIDVALIDITY from the last SELECT. A UID only names the same
+        # message while this is unchanged, so anything cached by UID keys on it too.
+        self.uidvalidity: Optional[int] = None
 
-    # ---------- internal sync helpers ----------
-
-    def _connect_sync(self) -> imaplib.IMAP4_SSL:
-        if self.provider == "gmail":
-            host = self.GMAIL_IMAP
-        elif self.provider == "outlook":
-            host = self.OUTLOOK_IMAP
-        else:
-            raise Exception(f"Unsupported provider: {self.provider}")
-
-        imap = imaplib.IMAP4_SSL(host)
+    @property
+    def is_connected(self) -> bool:
+        return self._ready
 
-        if self.use_oauth:
-            auth_string = self._oauth_string()
-            # authenticate exists at runtime, stubs just don't declare it
-            imap.authenticate("XOAUTH2", lambda _: auth_string)  # type: ignore[attr-defined]
-            print(f"{self.provider.capitalize()} IMAP connected (OAuth2)")
-        else:
-            imap.login(self.email, self.credential)
-            print(f"{self.provider.capitalize()} IMAP connected (password login)")
+    # ---------- internal helpers ----------
 
-        imap.select("INBOX")
-        self._imap = imap
-        return imap
+    def _host(self) -> str:
+        if self.provider == "gmail":
+            return self.GMAIL_IMAP
+        if self.provider == "outlook":
+            return self.OUTLOOK_IMAP
+        raise Exception(f"Unsupported provider: {self.provider}")
 
-    def _oauth_string(self) -> bytes:
-        # XOAUTH2 auth string with control char 0x01 separators
-        return f"user={self.email}\x01auth=Bearer {self.credential}\x01\x01".encode("utf-8")
+    async def _command(self, coro: Any, what: str) -> Any:
+        try:
+            resp = await coro
+        finally:
+            self.last_used = time.time()
+        if resp.result != "OK":
+            raise IMAPCommandError(f"IMAP {what} failed: {resp.result} {resp.lines[-1:]}")
+        return resp
 
-    def _fetch_latest_sync(self, limit: int) -> List[bytes]:
+    async def _open(self) -> None:
+        # TCP + TLS handshake and server greeting; needs no credentials
         if self._imap is None:
-            self._connect_sync()
+            imap = aioimaplib.IMAP4_SSL(host=self._host(), timeout=self.TIMEOUT)
+            await imap.wait_hello_from_server()
+            self._imap = imap
+
+    async def _connect(self) -> None:
+        await self._open()
         assert self._imap is not None  # for type checkers
-        imap = self._imap
 
-        status, msg_ids = imap.search(None, "ALL")
-        if status != "OK":
-            raise Exception(f"IMAP search failed: {status}")
+        try:
+            if self.use_oauth:
+                await self._command(self._imap.xoauth2(self.email, self.credential), "XOAUTH2")
+                print(f"{self.provider.capitalize()} IMAP connected (OAuth2)")
+            else:
+                await self._command(self._imap.login(self.email, self.credential), "LOGIN")
+                print(f"{self.provider.capitalize()} IMAP connected (password login)")
+        except IMAPCommandError as e:
+            raise IMAPAuthError(str(e)) from e
 
-        ids = msg_ids[0].split()
-        if not ids:
-            return []
+        resp = await self._command(self._imap.select("INBOX"), "SELECT")
+        self.uidvalidity = _parse_uidvalidity(resp.lines)
+        self._ready = True
 
-        ids = ids[-limit:]
+    async def _ensure_connected(self) -> aioimaplib.IMAP4_SSL:
+        # Caller holds self._lock
+        if not self._ready:
+            await self._connect()
+        assert self._imap is not None  # for type checkers
+        return self._imap
 
-        # Fetch all requested messages in a single FETCH command
-        # Build message set as string (e.g. "1,2,3") for type compatibility
-        id_list = ",".join(mid.decode() for mid in ids)
-        status, msg_data = imap.fetch(id_list, "(RFC822)")
-        if status != "OK":
-            raise Exception(f"IMAP fetch failed: {status}")
+    async def _connected(self) -> aioimaplib.IMAP4_SSL:
+        # For single commands that run without the lock; only (re)connecting takes it
+        if not self._ready:
+            async with self._lock:
+                return await self._ensure_connected()
+        assert self._imap is not None  # for type checkers
+        return self._imap
 
-        emails: List[bytes] = []
-        if msg_data:
-            for part in msg_data:
-                if isinstance(part, tuple) and len(part) >= 2 and part[1] is not None:
-                    emails.append(part[1])
+    async def _search_latest_uids(self, imap: aioimaplib.IMAP4_SSL, limit: int) -> List[bytes]:
+        resp = await self._command(imap.uid_search("ALL", charset=None), "search")
+        uids = resp.lines[0].split() if resp.lines else []
+        return uids[-limit:] if uids else []
 
-        return emails
+    async def _uid_fetch(
+        self, imap: aioimaplib.IMAP4_SSL, uid_set: str, items: str
+    ) -> List[Tuple[int, bytes]]:
+        resp = await self._command(imap.uid("fetch", uid_set, items), "fetch")
+        return _parse_fetch_lines(resp.lines)
 
-    def _logout_sync(self) -> None:
-        if self._imap is not None:
+    async def _uid_fetch_without_attachments(
+        self, imap: aioimaplib.IMAP4_SSL, uid_set: str
+    ) -> List[Tuple[int, bytes]]:
+        """
+        Like _uid_fetch(uid_set, FULL_ITEMS), but attachment bodies stay on the
+        server: BODYSTRUCTURE first, then only headers and inline text parts.
+        """
+        resp = await self._command(imap.uid("fetch", uid_set, "(BODYSTRUCTURE)"), "fetch")
+        structures: Dict[int, List[Any]] = {}
+        # Messages with the same MIME layout share one FETCH
+        groups: Dict[Tuple[str, ...], List[int]] = {}
+        fallback: List[int] = []
+        for fetched in _iter_fetch_responses(resp.lines):
+            # Unsolicited FETCHes (e.g. "* 2 FETCH (FLAGS (\Seen))") carry no UID
+            if b"UID" not in fetched:
+                continue
+            uid = int(fetched[b"UID"])
             try:
-                self._imap.logout()
-            finally:
-                self._imap = None
+                structures[uid] = fetched[b"BODYSTRUCTURE"]
+                groups.setdefault(tuple(_wanted_sections(structures[uid])), []).append(uid)
+            except (KeyError, IndexError, TypeError, ValueError, AttributeError):
+                fallback.append(uid)
+
+        emails: Dict[int, bytes] = {}
+        for sections, uids in groups.items():
+            items = "(" + " ".join(f"BODY.PEEK[{s}]" for s in sections) + ")"
+            resp = await self._command(
+                imap.uid("fetch", ",".join(map(str, uids)), items), "fetch"
+            )
+            for fetched in _iter_fetch_responses(resp.lines):
+                if b"UID" not in fetched:
+                    continue
+                uid = int(fetched[b"UID"])
+                parts = {
+                    name[5:-1].decode(): value or b""
+                    for name, value in fetched.items()
+                    if name.startswith(b"BODY[")
+                }
+                try:
+                    emails[uid] = _assemble(structures[uid], parts)
+                except (KeyError, IndexError, TypeError, ValueError, AttributeError):
+                    fallback.append(uid)
 
-    # ---------- generic async runner ----------
+        if fallback:
+            for uid, raw in await self._uid_fetch(imap, ",".join(map(str, fallback)), self.FULL_ITEMS):
+                emails[uid] = raw
+        return sorted(emails.items())
 
-    async def _run(self, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
-        return await asyncio.to_thread(func, *args, **kwargs)
+    async def _logout(self) -> None:
+        imap, self._imap = self._imap, None
+        self._ready = False
+        if imap is not None:
+            await imap.logout()
 
     # ---------- public async API ----------
 
-    async def connect(self) -> Any:
+    async def open(self) -> None:
+        """
+        Start the TLS handshake before the credential is known, e.g. while the
+        access token is still being refreshed. connect() finishes the login.
+        """
+        async with self._lock:
+            await self._open()
+
+    async def connect(self) -> None:
         async with self._lock:
-            return await self._run(self._connect_sync)
+            await self._connect()
 
-    async def fetch_latest(self, limit: int = 5) -> List[bytes]:
+    async def iter_latest(
+        self,
+        limit: int = 5,
+        batch_size: int = FETCH_BATCH_SIZE,
+        headers_only: bool = False,
+        skip_attachments: bool = False,
+    ) -> AsyncIterator[Tuple[int, bytes]]:
+        """
+        Yield (uid, raw_bytes) for the latest `limit` messages (oldest first)
+        as each batch arrives.
+
+        One UID FETCH is sent per batch, so callers can start processing the
+        first batch while the next one is still on the wire. With
+        headers_only=True only Subject/From/To/Date are downloaded; use
+        fetch_body(uid) for the full message later. With skip_attachments=True
+        attachments keep their MIME headers (filename, type, part number) but
+        arrive with an empty body; fetch_part(uid, part_id) gets one later.
+        """
+        items = self.HEADER_ITEMS if headers_only else self.FULL_ITEMS
+        skip_attachments = skip_attachments and not headers_only
+        async with self._lock:
+            imap = await self._ensure_connected()
+            uids = await self._search_latest_uids(imap, limit)
+            for start in range(0, len(uids), batch_size):
+                batch = uids[start:start + batch_size]
+                # SEARCH ALL returns every UID, so "first:last" covers exactly this batch
+                uid_range = f"{batch[0].decode()}:{batch[-1].decode()}"
+                if skip_attachments:
+                    fetched = await self._uid_fetch_without_attachments(imap, uid_range)
+                else:
+                    fetched = await self._uid_fetch(imap, uid_range, items)
+                for item in fetched:
+                    yield item
+
+    async def fetch_latest(
+        self,
+        limit: int = 5,
+        batch_size: int = FETCH_BATCH_SIZE,
+        headers_only: bool = False,
+        skip_attachments: bool = True,
+    ) -> List[bytes]:
+        return [
+            raw
+            async for _, raw in self.iter_latest(limit, batch_size, headers_only, skip_attachments)
+        ]
+
+    async def fetch_body(self, uid: int) -> Optional[bytes]:
+        """Full RFC822 bytes for one message, or None if the UID no longer exists."""
+        imap = await self._connected()
+        result = await self._uid_fetch(imap, str(uid), self.FULL_ITEMS)
+        return result[0][1] if result else None
+
+    async def fetch_part(self, uid: int, part_id: str) -> Optional[bytes]:
+        """
+        Raw bytes of one MIME part (e.g. an attachment) by IMAP section number,
+        still in its Content-Transfer-Encoding (see EmailParser.decode_part).
+        """
+        imap = await self._connected()
+        result = await self._uid_fetch(imap, str(uid), f"(BODY.PEEK[{part_id}])")
+        return result[0][1] if result else None
+
+    async def noop(self) -> None:
+        """Keep-alive / liveness check; raises one of IMAP_ERRORS if the connection is dead."""
+        imap = await self._connected()
+        await self._command(imap.noop(), "NOOP")
+
+    async def reauthenticate(self, credential: str) -> None:
+        """Switch to a new access token (e.g. after a refresh)."""
+        # IMAP has no way to re-AUTHENTICATE a logged-in session, so reconnect
         async with self._lock:
-            return await self._run(self._fetch_latest_sync, limit)
+            try:
+                await self._logout()
+            except IMAP_ERRORS:
+                pass
+            self.credential = credential
+            await self._connect()
 
     async def close(self) -> None:
         async with self._lock:
-            await self._run(self._logout_sync)
+            await self._logout()
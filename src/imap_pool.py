@@ -0,0 +1,177 @@
+# src/imap_pool.py
+
+import asyncio
+import concurrent.futures
+import threading
+import time
+from typing import Any, Awaitable, Callable, Coroutine, Dict, Optional, Tuple, TypeVar
+
+from src.accounts import (
+    get_access_token_for_account,
+    get_email_account_for_user,
+    invalidate_access_token,
+)
+from src.imap_client import AsyncIMAPClient, IMAPAuthError, IMAP_ERRORS
+
+
+T = TypeVar("T")
+
+# Pooled connections idle longer than this get a NOOP before reuse
+IDLE_CHECK_SECONDS = 300
+# Providers drop IMAP sessions idle for ~30 min; ping a little sooner
+KEEPALIVE_INTERVAL_SECONDS = 25 * 60
+# Connections nobody has used for this long are logged out by the keepalive task
+MAX_IDLE_SECONDS = 60 * 60
+
+# (user_id, account_id) -> (client, time.time() of last checkout)
+POOL: Dict[Tuple[int, int], Tuple[AsyncIMAPClient, float]] = {}
+# Serializes connect/reconnect per key so two reruns don't both open a session
+_KEY_LOCKS: Dict[Tuple[int, int], asyncio.Lock] = {}
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_lock = threading.Lock()
+_keepalive_future: Any = None
+
+
+# ---------- background event loop ----------
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    """
+    Event loop that owns every pooled connection. It runs forever on a daemon
+    thread, so connections survive Streamlit reruns and sessions.
+    """
+    global _loop, _keepalive_future
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="imap-pool", daemon=True).start()
+            _keepalive_future = asyncio.run_coroutine_threadsafe(_keepalive(), loop)
+            _loop = loop
+    return _loop
+
+
+def run_in_loop(coro: Coroutine[Any, Any, T]) -> T:
+    """Run `coro` on the pool's loop and block the calling thread until it's done."""
+    return submit(coro).result()
+
+
+def submit(coro: Coroutine[Any, Any, T]) -> "concurrent.futures.Future[T]":
+    """Schedule `coro` on the pool's loop and return at once (e.g. for prefetching)."""
+    return asyncio.run_coroutine_threadsafe(coro, get_loop())
+
+
+async def _keepalive() -> None:
+    while True:
+        await asyncio.sleep(KEEPALIVE_INTERVAL_SECONDS)
+        now = time.time()
+        for key, (client, checked_out) in list(POOL.items()):
+            if now - checked_out > MAX_IDLE_SECONDS:
+                await _evict(key, client)
+                continue
+            try:
+                await client.noop()
+            except Exception as e:
+                print(f"[imap_pool] Dropping dead connection for {client.email}: {e}")
+                await _evict(key, client)
+
+
+# ---------- pool ----------
+
+def _drop_key_lock(key: Tuple[int, int]) -> None:
+    lock = _KEY_LOCKS.get(key)
+    # A get_client() holding it is about to re-pool the key, so it stays then.
+    # Everything here runs on the pool's loop, so nothing can take it in between.
+    if lock is not None and not lock.locked():
+        del _KEY_LOCKS[key]
+
+
+async def _evict(key: Tuple[int, int], client: AsyncIMAPClient) -> None:
+    entry = POOL.get(key)
+    if entry is not None and entry[0] is client:
+        del POOL[key]
+        _drop_key_lock(key)
+    await asyncio.gather(client.close(), return_exceptions=True)
+
+
+async def _get_access_token(user_id: int, account_id: int) -> str:
+    # Usually a cache hit in src.accounts; the refresh (if any) runs off the loop
+    _, _, access_token = await asyncio.to_thread(
+        get_access_token_for_account, user_id, account_id
+    )
+    return access_token
+
+
+async def get_client(user_id: int, account_id: int) -> AsyncIMAPClient:
+    """
+    Return a connected client for the account, reusing the pooled one when
+    it is still alive.
+    """
+    key = (user_id, account_id)
+    async with _KEY_LOCKS.setdefault(key, asyncio.Lock()):
+        entry = POOL.get(key)
+        if entry is not None:
+            client = entry[0]
+            try:
+                access_token = await _get_access_token(user_id, account_id)
+                if client.credential != access_token:
+                    await client.reauthenticate(access_token)
+                elif time.time() - client.last_used > IDLE_CHECK_SECONDS:
+                    await client.noop()
+                POOL[key] = (client, time.time())
+                return client
+            except IMAP_ERRORS:
+                await _evict(key, client)
+
+        acc = await asyncio.to_thread(get_email_account_for_user, user_id, account_id)
+        if acc is None:
+            raise RuntimeError("Email account not found for current user")
+        client = AsyncIMAPClient(
+            provider=acc.provider,
+            email=acc.email_address,
+            credential="",
+            use_oauth=True,
+        )
+        # Token lookup and IMAP TLS handshake are independent round trips; overlap them
+        try:
+            access_token, _ = await asyncio.gather(
+                _get_access_token(user_id, account_id), client.open()
+            )
+            client.credential = access_token
+            await client.connect()
+        except Exception as e:
+            if isinstance(e, IMAPAuthError):
+                # Most likely the cached token was revoked or rejected; refresh next time
+                invalidate_access_token(account_id)
+            await asyncio.gather(client.close(), return_exceptions=True)
+            raise
+
+        POOL[key] = (client, time.time())
+        return client
+
+
+async def with_client(
+    user_id: int,
+    account_id: int,
+    op: Callable[[AsyncIMAPClient], Awaitable[T]],
+) -> T:
+    """
+    Run `op(client)` on the pooled connection for the account. The server may
+    have dropped that connection since the last NOOP, so reconnect once on
+    failure before giving up.
+    """
+    client = await get_client(user_id, account_id)
+    try:
+        return await op(client)
+    except IMAP_ERRORS:
+        await _evict((user_id, account_id), client)
+        client = await get_client(user_id, account_id)
+        return await op(client)
+
+
+async def close_user_clients(user_id: int) -> None:
+    """Log out every pooled connection belonging to the user (e.g. on log out)."""
+    clients = [POOL.pop(key)[0] for key in list(POOL) if key[0] == user_id]
+    # Includes keys whose connect failed and so never made it into POOL
+    for key in [key for key in _KEY_LOCKS if key[0] == user_id]:
+        _drop_key_lock(key)
+    await asyncio.gather(*(c.close() for c in clients), return_exceptions=True)
@@ -1,21 +1,114 @@
 import os
-import base64
-import json
-import requests
-from typing import Optional, Dict
+import time
+import binascii
+import hashlib
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
+import httpx
+import orjson
+from cachetools import TTLCache
+from typing import Callable, Optional, Dict, Tuple
+
+from src.http_client import get_client, sync_client
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
 
 # Where to write updated env vars (default: ".env" in project root)
 ENV_FILE_PATH = os.getenv("ENV_FILE_PATH", ".env")
 
+# Google and Microsoft both issue 1h access tokens unless told otherwise
+DEFAULT_TOKEN_LIFETIME = 3600
+
+# Cached access tokens are reused until this many seconds before they expire
+# (here and in src.accounts)
+ACCESS_TOKEN_EXPIRY_MARGIN = 300
+
+# sha256(refresh_token) -> (access_token, expires_at_epoch), for the plain
+# refresh_*_access_token helpers (test_run.py). src.accounts keeps its own
+# per-account cache and calls the uncached *_with_expiry variants.
+_ACCESS_CACHE: Dict[str, Tuple[str, float]] = {}
+# One lock per refresh token so concurrent callers trigger a single exchange
+_ACCESS_LOCKS: Dict[str, threading.Lock] = {}
+
+# An access token always belongs to the same mailbox, so its address can be
+# remembered for the token's lifetime. Keyed by sha256(token) so raw tokens
+# never sit in the cache.
+_GMAIL_EMAIL_CACHE: "TTLCache[str, str]" = TTLCache(maxsize=1024, ttl=DEFAULT_TOKEN_LIFETIME)
+_GMAIL_EMAIL_LOCK = threading.Lock()
+
+GMAIL_PROFILE_URL = "https://www.googleapis.com/gmail/v1/users/me/profile"
+GMAIL_TOKEN_URL = "https://oauth2.googleapis.com/token"
+GRAPH_ME_URL = "https://graph.microsoft.com/v1.0/me"
+
+# base64url -> standard base64 alphabet, for binascii
+_URLSAFE_TO_STD = bytes.maketrans(b"-_", b"+/")
+
 
 # ---------------- internal helpers ----------------
 
 
+def _token_key(token: str) -> str:
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+def _cached_refresh(
+    refresh_token: str, refresh: Callable[[], Optional[Tuple[str, float]]]
+) -> Optional[str]:
+    """Return the cached access token for refresh_token, or call refresh() for a new one."""
+    key = _token_key(refresh_token)
+    with _ACCESS_LOCKS.setdefault(key, threading.Lock()):
+        # Another caller may have refreshed while we waited for the lock
+        entry = _ACCESS_CACHE.get(key)
+        if entry and entry[1] - time.time() > ACCESS_TOKEN_EXPIRY_MARGIN:
+            return entry[0]
+
+        result = refresh()
+        if not result:
+            return None
+        _ACCESS_CACHE[key] = result
+        return result[0]
+
+
+def _cached_gmail_email(key: str) -> Optional[str]:
+    with _GMAIL_EMAIL_LOCK:
+        return _GMAIL_EMAIL_CACHE.get(key)
+
+
+def _remember_gmail_email(key: str, email_addr: Optional[str]) -> Optional[str]:
+    if email_addr:
+        with _GMAIL_EMAIL_LOCK:
+            _GMAIL_EMAIL_CACHE[key] = email_addr
+    return email_addr
+
+
+@contextmanager
+def _env_file_lock(env_path: str):
+    """Serialize .env writers across processes (POSIX only; no-op elsewhere)."""
+    if fcntl is None:
+        yield
+        return
+    with open(env_path + ".lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
 def _update_env_file(key: str, value: str, env_path: str = ENV_FILE_PATH) -> None:
     """
     Update KEY=VALUE in the .env file, or append it if missing.
     Also updates os.environ so the current process sees the new value.
+
+    The new file is streamed into a temp file next to it and swapped in with
+    os.replace, so concurrent readers see either the old or the new file.
     """
     if not value:
         return
@@ -23,29 +116,51 @@ def _update_env_file(key: str, value: str, env_path: str = ENV_FILE_PATH) -> Non
     os.environ[key] = value
 
     try:
-        lines = []
-        if os.path.exists(env_path):
-            with open(env_path, "r", encoding="utf-8") as f:
-                lines = f.readlines()
-
-        found = False
-        for i, line in enumerate(lines):
-            # very simple KEY=... matcher; ignores comments / exports
-            if line.startswith(f"{key}="):
-                lines[i] = f"{key}={value}\n"
-                found = True
-                break
-
-        if not found:
-            lines.append(f"{key}={value}\n")
-
-        with open(env_path, "w", encoding="utf-8") as f:
-            f.writelines(lines)
+        env_dir = os.path.dirname(os.path.abspath(env_path))
+        # Bytes throughout: other lines are copied untouched even if they
+        # aren't valid UTF-8, and the matcher is built once, not per line
+        prefix = f"{key}=".encode("utf-8")
+        new_line = prefix + value.encode("utf-8") + b"\n"
+        with _env_file_lock(env_path):
+            tmp = tempfile.NamedTemporaryFile(
+                "wb", dir=env_dir, prefix=".env.", suffix=".tmp", delete=False
+            )
+            try:
+                with tmp:
+                    found = False
+                    if os.path.exists(env_path):
+                        shutil.copymode(env_path, tmp.name)
+                        with open(env_path, "rb") as src:
+                            for line in src:
+                                # very simple KEY=... matcher; ignores comments / exports
+                                if not found and line.startswith(prefix):
+                                    line = new_line
+                                    found = True
+                                tmp.write(line)
+
+                    if not found:
+                        tmp.write(new_line)
+
+                    tmp.flush()
+                    os.fsync(tmp.fileno())
+                os.replace(tmp.name, env_path)
+            except BaseException:
+                os.unlink(tmp.name)
+                raise
     except Exception as e:
         # Non-fatal: your app should still work even if we can't write the file
         print(f"Warning: failed to update {env_path} for {key}: {e}")
 
 
+def _expires_at(body: Dict) -> float:
+    """Absolute epoch expiry for a token endpoint response body."""
+    try:
+        lifetime = int(body.get("expires_in") or DEFAULT_TOKEN_LIFETIME)
+    except (TypeError, ValueError):
+        lifetime = DEFAULT_TOKEN_LIFETIME
+    return time.time() + lifetime
+
+
 # ---------------- Gmail helpers ----------------
 
 
@@ -53,62 +168,111 @@ def get_gmail_email(access_token: str, timeout: int = 10) -> Optional[str]:
     """Return the Gmail address for the access_token using Gmail API /users/me/profile."""
     if not access_token:
         return None
-    url = "https://www.googleapis.com/gmail/v1/users/me/profile"
+    key = _token_key(access_token)
+    cached = _cached_gmail_email(key)
+    if cached:
+        return cached
+
     headers = {"Authorization": f"Bearer {access_token}"}
     try:
-        resp = requests.get(url, headers=headers, timeout=timeout)
+        resp = sync_client.get(GMAIL_PROFILE_URL, headers=headers, timeout=timeout)
         if resp.status_code == 200:
-            data = resp.json()
-            return data.get("emailAddress")
-    except requests.RequestException:
+            data = orjson.loads(resp.content)
+            return _remember_gmail_email(key, data.get("emailAddress"))
+    except httpx.HTTPError:
+        return None
+    return None
+
+
+async def get_gmail_email_async(
+    access_token: str, client: Optional[httpx.AsyncClient] = None, timeout: int = 10
+) -> Optional[str]:
+    """Async get_gmail_email for callers on an event loop (e.g. the FastAPI backend)."""
+    if not access_token:
+        return None
+    key = _token_key(access_token)
+    cached = _cached_gmail_email(key)
+    if cached:
+        return cached
+
+    headers = {"Authorization": f"Bearer {access_token}"}
+    try:
+        client = client or await get_client()
+        resp = await client.get(GMAIL_PROFILE_URL, headers=headers, timeout=timeout)
+        if resp.status_code == 200:
+            data = orjson.loads(resp.content)
+            return _remember_gmail_email(key, data.get("emailAddress"))
+    except httpx.HTTPError:
         return None
     return None
 
 
 def refresh_gmail_access_token(refresh_token: str, timeout: int = 10) -> Optional[str]:
     """
-    Use the OAuth2 refresh_token to get a fresh Gmail access token.
+    Use the OAuth2 refresh_token to get a fresh Gmail access token. The
+    previous access token is returned instead while it has more than
+    ACCESS_TOKEN_EXPIRY_MARGIN seconds left.
 
     If Google returns a new refresh_token (rotation), we transparently
     update GMAIL_REFRESH_TOKEN in both os.environ and the .env file.
     """
     if not refresh_token:
         return None
+    return _cached_refresh(
+        refresh_token,
+        lambda: refresh_gmail_access_token_with_expiry(refresh_token, timeout),
+    )
+
+
+def refresh_gmail_access_token_with_expiry(
+    refresh_token: str, timeout: int = 10
+) -> Optional[Tuple[str, float]]:
+    """
+    Like refresh_gmail_access_token, but returns (access_token, expires_at_epoch)
+    and always calls the token endpoint; callers cache the result themselves.
+    """
+    if not refresh_token:
+        return None
+
+    data = _gmail_refresh_data(refresh_token)
+    try:
+        resp = sync_client.post(GMAIL_TOKEN_URL, data=data, timeout=timeout)
+    except httpx.HTTPError as e:
+        print("Error refreshing Gmail token:", e)
+        return None
+    return _gmail_refresh_result(resp, refresh_token)
+
 
+def _gmail_refresh_data(refresh_token: str) -> Dict[str, str]:
     client_id = os.getenv("GMAIL_CLIENT_ID")
     client_secret = os.getenv("GMAIL_CLIENT_SECRET")
     if not client_id or not client_secret:
         raise RuntimeError("GMAIL_CLIENT_ID and GMAIL_CLIENT_SECRET must be set")
 
-    data = {
+    return {
         "client_id": client_id,
         "client_secret": client_secret,
         "refresh_token": refresh_token,
         "grant_type": "refresh_token",
     }
 
-    try:
-        resp = requests.post(
-            "https://oauth2.googleapis.com/token",
-            data=data,
-            timeout=timeout,
-        )
-        if resp.status_code == 200:
-            body = resp.json()
-            access_token = body.get("access_token")
-            new_refresh = body.get("refresh_token")
-
-            # Google may or may not return a new refresh token.
-            if new_refresh and new_refresh != refresh_token:
-                _update_env_file("GMAIL_REFRESH_TOKEN", new_refresh)
-
-            return access_token
-        else:
-            print("Failed to refresh Gmail token:", resp.status_code, resp.text)
-    except requests.RequestException as e:
-        print("Error refreshing Gmail token:", e)
 
-    return None
+def _gmail_refresh_result(resp: httpx.Response, refresh_token: str) -> Optional[Tuple[str, float]]:
+    if resp.status_code != 200:
+        print("Failed to refresh Gmail token:", resp.status_code, resp.text)
+        return None
+
+    body = orjson.loads(resp.content)
+    access_token = body.get("access_token")
+    new_refresh = body.get("refresh_token")
+
+    # Google may or may not return a new refresh token.
+    if new_refresh and new_refresh != refresh_token:
+        _update_env_file("GMAIL_REFRESH_TOKEN", new_refresh)
+
+    if not access_token:
+        return None
+    return access_token, _expires_at(body)
 
 
 # ---------------- Outlook helpers ----------------
@@ -124,52 +288,93 @@ def get_outlook_email_from_msal_result(msal_result: Dict, timeout: int = 10) ->
         return None
 
     # 1) Try id token claims first
-    id_claims = msal_result.get("id_token_claims") or {}
-    for key in ("preferred_username", "email", "upn", "unique_name", "userPrincipalName"):
-        val = id_claims.get(key)
-        if val:
-            return val
+    email_addr = _msal_claims_email(msal_result)
+    if email_addr:
+        return email_addr
 
     # 2) Try Graph /me using the access token
     access_token = msal_result.get("access_token")
     if access_token:
-        url = "https://graph.microsoft.com/v1.0/me"
         headers = {"Authorization": f"Bearer {access_token}"}
         try:
-            resp = requests.get(url, headers=headers, timeout=timeout)
-            if resp.status_code == 200:
-                data = resp.json()
-                return data.get("mail") or data.get("userPrincipalName")
-        except requests.RequestException:
+            resp = sync_client.get(GRAPH_ME_URL, headers=headers, timeout=timeout)
+            return _graph_me_email(resp)
+        except httpx.HTTPError:
             return None
 
     return None
 
 
-def get_outlook_email_from_access_token(access_token: str) -> Optional[str]:
-    """Extract Outlook email/UPN from the access token JWT itself."""
-    if not access_token:
+def _msal_claims_email(msal_result: Dict) -> Optional[str]:
+    id_claims = msal_result.get("id_token_claims") or {}
+    for key in ("preferred_username", "email", "upn", "unique_name", "userPrincipalName"):
+        val = id_claims.get(key)
+        if val:
+            return val
+    return None
+
+
+def _graph_me_email(resp: httpx.Response) -> Optional[str]:
+    if resp.status_code != 200:
+        return None
+    data = orjson.loads(resp.content)
+    return data.get("mail") or data.get("userPrincipalName")
+
+
+def _decode_jwt_claims(token: str) -> Optional[Dict]:
+    """Decode a JWT's payload (no signature check). None if it isn't a JWT."""
+    if not token:
+        return None
+
+    # JWT: header.payload.signature
+    _, dot, rest = token.partition(".")
+    if not dot:
         return None
+    payload_b64 = rest.partition(".")[0]
 
     try:
-        # JWT: header.payload.signature
-        parts = access_token.split(".")
-        if len(parts) < 2:
-            return None
+        # Non-strict a2b_base64 ignores surplus padding, so "==" always suffices
+        payload_bytes = binascii.a2b_base64(
+            payload_b64.encode("ascii").translate(_URLSAFE_TO_STD) + b"=="
+        )
+    except (binascii.Error, UnicodeEncodeError):
+        return None
+
+    try:
+        # Parses bytes directly, so no intermediate str is built
+        claims = orjson.loads(payload_bytes)
+    except ValueError:
+        return None
+
+    return claims if isinstance(claims, dict) else None
 
-        payload_b64 = parts[1]
-        # base64url decode with padding
-        padding = "=" * (-len(payload_b64) % 4)
-        payload_bytes = base64.urlsafe_b64decode(payload_b64 + padding)
-        claims = json.loads(payload_bytes.decode("utf-8"))
 
-        for key in ("preferred_username", "email", "upn", "unique_name", "userPrincipalName"):
-            val = claims.get(key)
-            if val:
-                return val
-    except Exception:
+def is_jwt_valid(token: str, margin: int = 30) -> bool:
+    """True if token is a JWT whose exp claim is more than `margin` seconds away.
+
+    Opaque tokens (e.g. Google's ya29.*) can't be checked locally and return False.
+    """
+    claims = _decode_jwt_claims(token)
+    if not claims:
+        return False
+    try:
+        return time.time() < float(claims["exp"]) - margin
+    except (KeyError, TypeError, ValueError):
+        return False
+
+
+@lru_cache(maxsize=256)
+def get_outlook_email_from_access_token(access_token: str) -> Optional[str]:
+    """Extract Outlook email/UPN from the access token JWT itself (memoized per token)."""
+    claims = _decode_jwt_claims(access_token)
+    if not claims:
         return None
 
+    for key in ("preferred_username", "email", "upn", "unique_name", "userPrincipalName"):
+        val = claims.get(key)
+        if val:
+            return val
+
     return None
 
 
@@ -177,10 +382,34 @@ def refresh_outlook_access_token(refresh_token: str) -> Optional[str]:
     """Use the OAuth2 refresh_token to get a fresh Outlook access token.
     
     Supports both public clients (no secret) and confidential clients (with secret).
+    Like the Gmail variant, a still-valid access token is reused.
+    """
+    if not refresh_token:
+        return None
+    return _cached_refresh(
+        refresh_token,
+        lambda: refresh_outlook_access_token_with_expiry(refresh_token),
+    )
+
+
+def refresh_outlook_access_token_with_expiry(refresh_token: str) -> Optional[Tuple[str, float]]:
+    """
+    Like refresh_outlook_access_token, but returns (access_token, expires_at_epoch)
+    and always calls the token endpoint; callers cache the result themselves.
     """
     if not refresh_token:
         return None
 
+    token_endpoint, data = _outlook_refresh_request(refresh_token)
+    try:
+        resp = sync_client.post(token_endpoint, data=data, timeout=10)
+    except httpx.HTTPError as e:
+        print("Outlook refresh failed (network error):", e)
+        return None
+    return _outlook_refresh_result(resp)
+
+
+def _outlook_refresh_request(refresh_token: str) -> Tuple[str, Dict[str, str]]:
     client_id = os.getenv("OUTLOOK_CLIENT_ID")
     client_secret = os.getenv("OUTLOOK_CLIENT_SECRET")
     tenant_id = os.getenv("OUTLOOK_TENANT_ID", "common")
@@ -208,16 +437,16 @@ def refresh_outlook_access_token(refresh_token: str) -> Optional[str]:
     if client_secret:
         data["client_secret"] = client_secret
 
-    try:
-        resp = requests.post(token_endpoint, data=data, timeout=10)
-    except requests.RequestException as e:
-        print("Outlook refresh failed (network error):", e)
-        return None
+    return token_endpoint, data
 
+
+def _outlook_refresh_result(resp: httpx.Response) -> Optional[Tuple[str, float]]:
     if resp.status_code == 200:
-        body = resp.json()
-        return body.get("access_token")
+        body = orjson.loads(resp.content)
+        access_token = body.get("access_token")
+        if not access_token:
+            return None
+        return access_token, _expires_at(body)
 
     print("Outlook refresh failed:", resp.status_code, resp.text)
     return None
-
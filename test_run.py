@@ -2,6 +2,9 @@
 
 import os
 import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Tuple
 from dotenv import load_dotenv
 
 from src.email_parser import EmailParser
@@ -11,6 +14,7 @@ from src.token_utils import (
     refresh_gmail_access_token,
     refresh_outlook_access_token,
     get_outlook_email_from_access_token,
+    is_jwt_valid,
 )
 
 load_dotenv()
@@ -26,20 +30,23 @@ def show(parsed):
     print("Attachments:", len(parsed["attachments"]))
 
 
-async def main():
-    # ----------- GMAIL -----------
+def resolve_gmail() -> Tuple[str, str]:
+    """Return (email, access_token) for Gmail from .env settings."""
     print("\n--- GMAIL IMAP (async) ---")
 
     gmail_token: str | None = None
 
+    # Skip the token endpoint while the saved access token is provably still valid
+    gmail_access = os.getenv("GMAIL_ACCESS_TOKEN")
+    if gmail_access and is_jwt_valid(gmail_access):
+        gmail_token = gmail_access
+
     gmail_refresh = os.getenv("GMAIL_REFRESH_TOKEN")
-    if gmail_refresh:
+    if not gmail_token and gmail_refresh:
         gmail_token = refresh_gmail_access_token(gmail_refresh)
 
-    if not gmail_token:
-        gmail_access = os.getenv("GMAIL_ACCESS_TOKEN")
-        if gmail_access:
-            gmail_token = gmail_access
+    if not gmail_token and gmail_access:
+        gmail_token = gmail_access
 
     if not gmail_token:
         raise RuntimeError(
@@ -57,26 +64,26 @@ async def main():
             "Set GMAIL_EMAIL or check the token/refresh flow."
         )
 
-    gmail_client = AsyncIMAPClient(
-        provider="gmail",
-        email=gmail_email,
-        credential=gmail_token,
-        use_oauth=True,
-    )
+    return gmail_email, gmail_token
 
-    # ----------- OUTLOOK -----------
+
+def resolve_outlook() -> Tuple[str, str]:
+    """Return (email, access_token) for Outlook from .env settings."""
     print("\n--- OUTLOOK IMAP (async) ---")
 
     outlook_token: str | None = None
 
+    # Skip the token endpoint while the saved access token is provably still valid
+    outlook_access = os.getenv("OUTLOOK_ACCESS_TOKEN")
+    if outlook_access and is_jwt_valid(outlook_access):
+        outlook_token = outlook_access
+
     outlook_refresh = os.getenv("OUTLOOK_REFRESH_TOKEN")
-    if outlook_refresh:
+    if not outlook_token and outlook_refresh:
         outlook_token = refresh_outlook_access_token(outlook_refresh)
 
-    if not outlook_token:
-        outlook_access = os.getenv("OUTLOOK_ACCESS_TOKEN")
-        if outlook_access:
-            outlook_token = outlook_access
+    if not outlook_token and outlook_access:
+        outlook_token = outlook_access
 
     if not outlook_token:
         raise RuntimeError(
@@ -84,6 +91,7 @@ async def main():
             "Set OUTLOOK_REFRESH_TOKEN (and OUTLOOK_CLIENT_ID / OUTLOOK_TENANT_ID) or OUTLOOK_ACCESS_TOKEN in .env."
         )
 
+    # Decoded locally from the JWT, no network call
     outlook_email = get_outlook_email_from_access_token(outlook_token) or os.getenv("OUTLOOK_EMAIL")
 
     if not outlook_email:
@@ -92,12 +100,23 @@ async def main():
             "Ensure the token includes a username/email claim or set OUTLOOK_EMAIL in .env."
         )
 
-    outlook_client = AsyncIMAPClient(
-        provider="outlook",
-        email=outlook_email,
-        credential=outlook_token,
-        use_oauth=True,
+    return outlook_email, outlook_token
+
+
+async def main():
+    # Email and token are filled in once resolved; the host only depends on provider
+    gmail_client = AsyncIMAPClient(provider="gmail", email="", credential="", use_oauth=True)
+    outlook_client = AsyncIMAPClient(provider="outlook", email="", credential="", use_oauth=True)
+
+    # ----------- tokens + TLS handshakes in parallel -----------
+    (gmail_email, gmail_token), (outlook_email, outlook_token), _, _ = await asyncio.gather(
+        asyncio.to_thread(resolve_gmail),
+        asyncio.to_thread(resolve_outlook),
+        gmail_client.open(),
+        outlook_client.open(),
     )
+    gmail_client.email, gmail_client.credential = gmail_email, gmail_token
+    outlook_client.email, outlook_client.credential = outlook_email, outlook_token
 
     # ----------- connect in parallel -----------
     await asyncio.gather(
@@ -106,23 +125,35 @@ async def main():
     )
 
     # ----------- fetch in parallel -----------
+    # fetch_latest leaves attachment bodies on the server (skip_attachments=True)
     gmail_msgs, outlook_msgs = await asyncio.gather(
         gmail_client.fetch_latest(2),
         outlook_client.fetch_latest(2),
     )
 
+    # ----------- parse in parallel (CPU-bound, so processes) -----------
+    # show() only prints an attachment count
+    parse = partial(EmailParser.parse, decode_attachments=False)
+    loop = asyncio.get_running_loop()
+    with ProcessPoolExecutor() as pool:
+        parsed, _ = await asyncio.gather(
+            asyncio.gather(
+                *(loop.run_in_executor(pool, parse, raw) for raw in gmail_msgs + outlook_msgs)
+            ),
+            # Log out while the workers parse
+            asyncio.gather(
+                gmail_client.close(),
+                outlook_client.close(),
+            ),
+        )
+
     print("\n--- GMAIL ---")
-    for raw in gmail_msgs:
-        show(EmailParser.parse(raw))
+    for msg in parsed[:len(gmail_msgs)]:
+        show(msg)
 
     print("\n--- OUTLOOK ---")
-    for raw in outlook_msgs:
-        show(EmailParser.parse(raw))
-
-    await asyncio.gather(
-        gmail_client.close(),
-        outlook_client.close(),
-    )
+    for msg in parsed[len(gmail_msgs):]:
+        show(msg)
 
 
 if __name__ == "__main__":
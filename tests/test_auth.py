@@ -0,0 +1,36 @@
+import importlib
+
+import pytest
+
+
+@pytest.fixture
+def auth(tmp_path, monkeypatch):
+    # src.auth builds its engine at import time, so point it at a fresh DB and reload
+    monkeypatch.setenv("APP_DB_URL", f"sqlite:///{tmp_path / 'app.db'}")
+    import src.auth
+
+    module = importlib.reload(src.auth)
+    module.create_db_and_tables()
+    yield module
+    module.engine.dispose()
+
+
+def test_register_normalizes_email(auth):
+    user = auth.register_user("  Foo@Example.COM ", "secret")
+
+    assert user.email == "foo@example.com"
+
+
+def test_register_rejects_duplicate_with_different_case_and_whitespace(auth):
+    auth.register_user("  Foo@Example.COM ", "secret")
+
+    with pytest.raises(ValueError):
+        auth.register_user("foo@example.com", "other")
+
+
+def test_login_ignores_case_and_whitespace(auth):
+    user = auth.register_user("  Foo@Example.COM ", "secret")
+
+    assert auth.authenticate_user("FOO@example.com", "secret").id == user.id
+    assert auth.authenticate_user(" foo@EXAMPLE.com  ", "secret").id == user.id
+    assert auth.authenticate_user("FOO@example.com", "wrong") is None
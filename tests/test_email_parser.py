@@ -0,0 +1,24 @@
+import base64
+
+from src.email_parser import EmailParser
+
+
+PDF_BYTES = b"%PDF-1.4\n1 0 obj << /Type /Catalog >> endobj\ntrailer << /Root 1 0 R >>\n%%EOF\n"
+
+
+def test_data_url_for_small_pdf():
+    url = EmailParser.data_url(PDF_BYTES, "application/pdf")
+
+    prefix = "data:application/pdf;base64,"
+    assert url.startswith(prefix)
+    assert base64.b64decode(url[len(prefix):]) == PDF_BYTES
+
+
+def test_data_url_for_decoded_attachment_part():
+    # What the app previews: a base64 attachment fetched via BODY[<part>] and decoded
+    encoded = base64.encodebytes(PDF_BYTES)
+    content = EmailParser.decode_part(encoded, "base64")
+
+    assert EmailParser.data_url(content, "application/pdf") == (
+        "data:application/pdf;base64," + base64.b64encode(PDF_BYTES).decode("ascii")
+    )
@@ -0,0 +1,94 @@
+import asyncio
+from types import SimpleNamespace
+
+from src.email_parser import EmailParser
+from src.imap_client import AsyncIMAPClient, _iter_fetch_responses, _parse_uidvalidity
+
+
+# multipart/mixed: text/plain + a PDF attachment
+STRUCTURE = (
+    b'(("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "7BIT" 5 1 NIL NIL NIL)'
+    b'("APPLICATION" "PDF" ("NAME" "a.pdf") NIL NIL "BASE64" 1000 NIL'
+    b' ("ATTACHMENT" ("FILENAME" "a.pdf")) NIL) "MIXED" ("BOUNDARY" "mix") NIL NIL)'
+)
+# Unsolicited flag update a server may interleave with any response
+FLAGS_ONLY = b"2 FETCH (FLAGS (\\Seen))"
+
+
+def test_iter_fetch_responses_keeps_flags_only_fetch_without_uid():
+    lines = [
+        b"1 FETCH (UID 42 BODY[HEADER] {12}",
+        bytearray(b"Subject: a\r\n"),
+        b")",
+        FLAGS_ONLY,
+        b"3 FETCH (UID 44 BODY[HEADER] NIL)",
+        b"FETCH completed",
+    ]
+
+    responses = list(_iter_fetch_responses(lines))
+
+    assert responses == [
+        {b"UID": b"42", b"BODY[HEADER]": b"Subject: a\r\n"},
+        {b"FLAGS": [b"\\Seen"]},
+        {b"UID": b"44", b"BODY[HEADER]": None},
+    ]
+
+
+class FakeIMAP:
+    """Answers the two UID FETCHes of _uid_fetch_without_attachments."""
+
+    def __init__(self):
+        self.commands = []
+
+    async def uid(self, command, uid_set, items):
+        self.commands.append(items)
+        if items == "(BODYSTRUCTURE)":
+            lines = [b"1 FETCH (UID 42 BODYSTRUCTURE " + STRUCTURE + b")", FLAGS_ONLY]
+        else:
+            header = b'Subject: hi\r\nContent-Type: multipart/mixed; boundary="mix"\r\n\r\n'
+            text_mime = b"Content-Type: text/plain\r\n\r\n"
+            pdf_mime = (
+                b"Content-Type: application/pdf\r\n"
+                b"Content-Disposition: attachment; filename=a.pdf\r\n"
+                b"Content-Transfer-Encoding: base64\r\n\r\n"
+            )
+            lines = [
+                FLAGS_ONLY,
+                b"1 FETCH (UID 42 BODY[HEADER] {%d}" % len(header),
+                bytearray(header),
+                b" BODY[1.MIME] {%d}" % len(text_mime),
+                bytearray(text_mime),
+                b" BODY[1] {5}",
+                bytearray(b"hello"),
+                b" BODY[2.MIME] {%d}" % len(pdf_mime),
+                bytearray(pdf_mime),
+                b")",
+            ]
+        return SimpleNamespace(result="OK", lines=lines + [b"FETCH completed"])
+
+
+def test_fetch_without_attachments_ignores_unsolicited_fetch():
+    client = AsyncIMAPClient(provider="gmail", email="me@example.com", credential="")
+    imap = FakeIMAP()
+
+    emails = asyncio.run(client._uid_fetch_without_attachments(imap, "42"))
+
+    assert [uid for uid, _ in emails] == [42]
+    assert imap.commands[1] == "(BODY.PEEK[HEADER] BODY.PEEK[1.MIME] BODY.PEEK[1] BODY.PEEK[2.MIME])"
+    parsed = EmailParser.parse(emails[0][1], decode_attachments=False)
+    assert parsed["subject"] == "hi"
+    assert parsed["text"] == "hello"
+    assert [(a["filename"], a["part_id"]) for a in parsed["attachments"]] == [("a.pdf", "2")]
+
+
+def test_parse_uidvalidity_from_select_response():
+    lines = [
+        b"172 EXISTS",
+        b"1 RECENT",
+        b"OK [UIDVALIDITY 3857529045] UIDs valid",
+        b"OK [UIDNEXT 4392] Predicted next UID",
+        b"[READ-WRITE] SELECT completed",
+    ]
+
+    assert _parse_uidvalidity(lines) == 3857529045
+    assert _parse_uidvalidity([b"[READ-WRITE] SELECT completed"]) is None